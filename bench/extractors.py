@@ -0,0 +1,113 @@
+"""Micro-benchmark for the prnt.sc page extractors in main.py.
+
+Runs every extractor in HTML_EXTRACTORS (plus the full fallback chain)
+over a corpus of saved prnt.sc pages and reports per-page timings and
+how often each extractor agrees with the bs4 reference.
+
+    python bench/extractors.py --fetch 200       # save 200 random pages
+    python bench/extractors.py --repeat 20 --json
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+
+DEFAULT_CORPUS_DIR = Path(__file__).resolve().parent / "corpus"
+
+
+def fetch_corpus(corpus_dir: Path, count: int):
+    corpus_dir.mkdir(parents=True, exist_ok=True)
+    with httpx.Client(headers=main.COMMON_HEADERS, follow_redirects=True, timeout=main.HTTP_TIMEOUT) as client:
+        saved = 0
+        while saved < count:
+            prnt_id = main.generate_id()
+            try:
+                resp = client.get(f"{main.PRNT_BASE_URL}/{prnt_id}")
+            except httpx.HTTPError as exc:
+                print(f"[corpus] error for id={prnt_id}: {exc}")
+                continue
+            if resp.status_code != 200:
+                print(f"[corpus] non-200 ({resp.status_code}) for id={prnt_id}, stopping")
+                break
+            (corpus_dir / f"{prnt_id}.html").write_bytes(resp.content)
+            saved += 1
+            # stay well inside the upstream budget
+            time.sleep(main.PRNT_RATE_WINDOW / main.PRNT_RATE_LIMIT)
+    print(f"[corpus] saved {saved} pages into {corpus_dir}")
+
+
+def load_corpus(corpus_dir: Path):
+    pages = [path.read_bytes() for path in sorted(corpus_dir.glob("*.html"))]
+    if not pages:
+        raise SystemExit(f"no *.html pages in {corpus_dir}, run with --fetch N first")
+    return pages
+
+
+def time_extractor(extractor, pages, repeat: int):
+    per_page = []
+    results = []
+    for html in pages:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            result = extractor(html)
+        per_page.append((time.perf_counter() - start) / repeat)
+        results.append(result)
+    return per_page, results
+
+
+def run(pages, repeat: int):
+    extractors = dict(main.HTML_EXTRACTORS)
+    extractors["chain"] = main.extract_image_url_from_html
+    if main.lxml_html is None:
+        extractors.pop("lxml")
+
+    _, reference = time_extractor(main.HTML_EXTRACTORS["bs4"], pages, 1)
+    report = {"pages": len(pages), "repeat": repeat, "extractors": {}}
+    for name, extractor in extractors.items():
+        per_page, results = time_extractor(extractor, pages, repeat)
+        per_page_us = sorted(value * 1e6 for value in per_page)
+        report["extractors"][name] = {
+            "mean_us": statistics.fmean(per_page_us),
+            "p50_us": per_page_us[len(per_page_us) // 2],
+            "p99_us": per_page_us[min(len(per_page_us) - 1, int(len(per_page_us) * 0.99))],
+            "found": sum(1 for result in results if result),
+            "agrees_with_bs4": sum(1 for result, ref in zip(results, reference) if result == ref),
+        }
+    report["ban_keyword_scan_us"] = statistics.fmean(time_extractor(main.contains_ban_keyword, pages, repeat)[0]) * 1e6
+    return report
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", type=Path, default=DEFAULT_CORPUS_DIR)
+    parser.add_argument("--fetch", type=int, default=0, help="download N random pages into the corpus first")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    if args.fetch:
+        fetch_corpus(args.corpus, args.fetch)
+    report = run(load_corpus(args.corpus), args.repeat)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{report['pages']} pages, {report['repeat']} runs each")
+    print(f"{'extractor':<8} {'mean us':>10} {'p50 us':>10} {'p99 us':>10} {'found':>6} {'=bs4':>6}")
+    for name, stats in report["extractors"].items():
+        print(
+            f"{name:<8} {stats['mean_us']:>10.1f} {stats['p50_us']:>10.1f} {stats['p99_us']:>10.1f} "
+            f"{stats['found']:>6} {stats['agrees_with_bs4']:>6}"
+        )
+    print(f"ban keyword scan: {report['ban_keyword_scan_us']:.1f} us/page")
+
+
+if __name__ == "__main__":
+    main_cli()
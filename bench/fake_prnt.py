@@ -0,0 +1,144 @@
+"""Local stand-in for prnt.sc and its image host, for benchmarks.
+
+Serves screenshot pages at /{id} and images at /img/{id}.png with a
+configurable hit ratio, latency distribution, image sizes and injected
+429/403 responses or ban-keyword pages. --client-rate-limit bans every client
+address (X-Forwarded-For, as set by bench/fake_proxy.py, or the peer) that
+goes over its own budget, like prnt.sc. Point the service at it with
+PRNT_BASE_URL:
+
+    python bench/fake_prnt.py --port 8765 --hit-ratio 0.3 --latency-ms 80
+    PRNT_BASE_URL=http://127.0.0.1:8765 uvicorn main:app
+
+GET /__stats returns the request counters as JSON, pages per client under "clients".
+"""
+import argparse
+import asyncio
+import hashlib
+import random
+import time
+from collections import Counter, deque
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, Response
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+NOT_FOUND_IMAGE = "//st.prntscr.com/2023/07/24/0635/img/0_173a7b_211be8ff.png"
+BAN_PAGE = "<html><head><title>Access denied</title></head><body>You have been temporarily blocked.</body></html>"
+
+
+def build_app(args) -> FastAPI:
+    app = FastAPI()
+    stats = Counter()
+    client_pages = Counter()
+    client_windows = {}
+    client_banned_until = {}
+    base_url = f"http://{args.host}:{args.port}"
+
+    async def upstream_latency():
+        if args.latency_ms > 0:
+            # lognormal, so there is a tail like a real upstream
+            await asyncio.sleep(random.lognormvariate(0, args.latency_sigma) * args.latency_ms / 1000)
+
+    def is_hit(prnt_id: str) -> bool:
+        # deterministic per ID, so retries of the same ID see the same page
+        digest = hashlib.blake2b(prnt_id.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big") / 2**64 < args.hit_ratio
+
+    def client_is_banned(request: Request) -> bool:
+        if not args.client_rate_limit:
+            return False
+        client = request.headers.get("x-forwarded-for") or request.client.host
+        now = time.monotonic()
+        if client_banned_until.get(client, 0) > now:
+            return True
+        window = client_windows.setdefault(client, deque())
+        while window and now - window[0] >= 60:
+            window.popleft()
+        if len(window) >= args.client_rate_limit:
+            client_banned_until[client] = now + args.client_ban_seconds
+            stats["client_bans"] += 1
+            return True
+        window.append(now)
+        client_pages[client] += 1
+        return False
+
+    @app.get("/__stats")
+    async def fake_stats():
+        return {**stats, "clients": dict(client_pages)}
+
+    @app.get("/img/{file_name}")
+    async def image(file_name: str):
+        await upstream_latency()
+        stats["images"] += 1
+        size = random.randint(args.image_min_kb * 1024, args.image_max_kb * 1024)
+        return Response(PNG_SIGNATURE + random.randbytes(max(0, size - len(PNG_SIGNATURE))), media_type="image/png")
+
+    @app.get("/")
+    async def index(request: Request):
+        stats["probes"] += 1
+        if client_is_banned(request):
+            return Response(status_code=429)
+        return HTMLResponse("<html><body>prnt.sc stand-in</body></html>")
+
+    @app.get("/{prnt_id}")
+    async def page(prnt_id: str, request: Request):
+        await upstream_latency()
+        stats["pages"] += 1
+        if client_is_banned(request):
+            stats["429"] += 1
+            return Response(status_code=429)
+        roll = random.random()
+        if roll < args.rate_429:
+            stats["429"] += 1
+            return Response(status_code=429)
+        roll -= args.rate_429
+        if roll < args.rate_403:
+            stats["403"] += 1
+            return Response(status_code=403)
+        roll -= args.rate_403
+        if roll < args.ban_page_rate:
+            stats["ban_pages"] += 1
+            return HTMLResponse(BAN_PAGE)
+        if is_hit(prnt_id):
+            stats["hits"] += 1
+            image_url = f"{base_url}/img/{prnt_id}.png"
+        else:
+            image_url = NOT_FOUND_IMAGE
+        return HTMLResponse(
+            "<html><head><title>Screenshot</title>"
+            f'<meta property="og:image" content="{image_url}"/></head><body>'
+            f'<img class="no-click screenshot-image" src="{image_url}" id="screenshot-image">'
+            "</body></html>"
+        )
+
+    return app
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--hit-ratio", type=float, default=0.3, help="share of IDs with a real screenshot")
+    parser.add_argument("--latency-ms", type=float, default=50, help="median upstream latency")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="lognormal sigma of the latency")
+    parser.add_argument("--image-min-kb", type=int, default=50)
+    parser.add_argument("--image-max-kb", type=int, default=400)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of pages answered with 429")
+    parser.add_argument("--rate-403", type=float, default=0.0, help="share of pages answered with 403")
+    parser.add_argument("--ban-page-rate", type=float, default=0.0, help="share of pages with a ban keyword")
+    parser.add_argument(
+        "--client-rate-limit", type=int, default=0, help="pages per minute per client address before a ban, 0 is off"
+    )
+    parser.add_argument("--client-ban-seconds", type=float, default=30, help="how long a client ban lasts")
+    return parser
+
+
+def main_cli():
+    args = build_parser().parse_args()
+    uvicorn.run(build_app(args), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main_cli()
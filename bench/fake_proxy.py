@@ -0,0 +1,97 @@
+"""Local HTTP forward proxies standing in for egress routes, for benchmarks.
+
+Listens on --count consecutive ports from --base-port. Each port forwards
+plain-http requests (absolute-form request targets, as httpx sends them to
+a proxy) and tags them with its own X-Forwarded-For address, so
+bench/fake_prnt.py --client-rate-limit can rate limit and ban every proxy
+separately, like prnt.sc does per source address:
+
+    python bench/fake_proxy.py --base-port 9100 --count 3
+    PRNT_EGRESS_ROUTES=http://127.0.0.1:9100,http://127.0.0.1:9101,http://127.0.0.1:9102 uvicorn main:app
+"""
+import argparse
+import asyncio
+
+import httpx
+
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authorization",
+    "proxy-connection",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
+
+
+async def read_request(reader: asyncio.StreamReader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    request_line, *header_lines = head.decode("latin-1").split("\r\n")
+    method, target, _ = request_line.split(" ", 2)
+    headers = {}
+    for line in header_lines:
+        if line:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", "0")))
+    return method, target, headers, body
+
+
+async def serve_connection(reader, writer, client: httpx.AsyncClient, forwarded_for: str):
+    try:
+        while True:
+            try:
+                method, target, headers, body = await read_request(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            if not target.startswith("http://"):
+                writer.write(b"HTTP/1.1 501 Not Implemented\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                await writer.drain()
+                return
+            upstream_headers = {name: value for name, value in headers.items() if name not in HOP_BY_HOP_HEADERS}
+            upstream_headers.pop("host", None)
+            upstream_headers["x-forwarded-for"] = forwarded_for
+            try:
+                resp = await client.request(method, target, headers=upstream_headers, content=body)
+                status, reason, content = resp.status_code, resp.reason_phrase, resp.content
+                resp_headers = [
+                    (name, value)
+                    for name, value in resp.headers.items()
+                    if name.lower() not in HOP_BY_HOP_HEADERS | {"content-length", "content-encoding"}
+                ]
+            except httpx.HTTPError:
+                status, reason, content, resp_headers = 502, "Bad Gateway", b"", []
+            lines = [f"HTTP/1.1 {status} {reason}", *(f"{name}: {value}" for name, value in resp_headers)]
+            lines.append(f"Content-Length: {len(content)}")
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + content)
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def run(args):
+    async with httpx.AsyncClient(timeout=30) as client:
+        servers = []
+        for idx in range(args.count):
+            forwarded_for = f"10.0.0.{idx + 1}"
+
+            async def handle(reader, writer, forwarded_for=forwarded_for):
+                await serve_connection(reader, writer, client, forwarded_for)
+
+            servers.append(await asyncio.start_server(handle, args.host, args.base_port + idx))
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--base-port", type=int, default=9100)
+    parser.add_argument("--count", type=int, default=3, help="number of proxies, one port each")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main_cli()
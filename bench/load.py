@@ -0,0 +1,256 @@
+"""End-to-end load test of the service against bench/fake_prnt.py.
+
+Boots the fake upstream and the service (uvicorn, in a scratch working
+directory, so storage/ starts empty), runs the scenarios and prints one JSON
+document, suitable for tracking regressions between releases:
+
+    cold_start  seconds until /healthz answers and until /readyz is 200
+    memory      RSS growth per item in the memory tier (single worker only)
+    page        / throughput and latency under --clients concurrent clients
+    image       /img and /storage latency for the image each page points at
+    fetcher     valid screenshots per upstream page request
+    egress      rate and ban state of every egress route (single worker only)
+
+    python bench/load.py --duration 20 --clients 32 --output bench/results.json
+    python bench/load.py --workers 2 --rate-429 0.01   # shared mode, /storage only
+    python bench/load.py --egress-proxies 3 --client-rate-limit 600 --rate-limit 600
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+import httpx
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+FAKE_PRNT = Path(__file__).resolve().parent / "fake_prnt.py"
+FAKE_PROXY = Path(__file__).resolve().parent / "fake_proxy.py"
+IMAGE_SRC_PATTERN = re.compile(r'<img[^>]*\ssrc="(/(?:img|storage)/[^"]+)"')
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def latency_summary(samples, duration: float):
+    if not samples:
+        return {"requests": 0}
+    ordered = sorted(samples)
+    return {
+        "requests": len(ordered),
+        "rps": len(ordered) / duration,
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def read_rss_bytes(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def read_metric(metrics_text: str, name: str) -> float:
+    total = 0.0
+    for line in metrics_text.splitlines():
+        if line.startswith(name) and not line.startswith(f"{name}_created"):
+            total += float(line.rsplit(" ", 1)[1])
+    return total
+
+
+async def wait_for(client: httpx.AsyncClient, url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get(url)).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.02)
+    raise SystemExit(f"{url} not ready after {timeout}s")
+
+
+async def page_client(client: httpx.AsyncClient, base: str, deadline: float, results):
+    while time.monotonic() < deadline:
+        started = time.monotonic()
+        try:
+            resp = await client.get(f"{base}/")
+        except httpx.HTTPError:
+            results["statuses"]["error"] += 1
+            continue
+        results["page"].append(time.monotonic() - started)
+        results["statuses"][resp.status_code] += 1
+        match = IMAGE_SRC_PATTERN.search(resp.text)
+        if not match:
+            continue
+        image_path = match.group(1)
+        kind = image_path.split("/")[1]
+        started = time.monotonic()
+        try:
+            image_resp = await client.get(f"{base}{image_path}")
+        except httpx.HTTPError:
+            results["statuses"][f"{kind}_error"] += 1
+            continue
+        results[kind].append(time.monotonic() - started)
+        results["statuses"][f"{kind}_{image_resp.status_code}"] += 1
+
+
+async def run_scenarios(args, service: subprocess.Popen, service_started: float, base: str, fake_base: str):
+    report = {}
+    async with httpx.AsyncClient(timeout=args.request_timeout) as client:
+        await wait_for(client, f"{base}/healthz", args.startup_timeout)
+        healthz_s = time.monotonic() - service_started
+        rss_base = read_rss_bytes(service.pid) if args.workers == 1 else 0
+        await wait_for(client, f"{base}/readyz", args.startup_timeout)
+        report["cold_start"] = {"healthz_s": healthz_s, "readyz_s": time.monotonic() - service_started}
+
+        if args.workers == 1:
+            # let the memory tier fill up before measuring its footprint
+            deadline = time.monotonic() + args.warmup
+            memory_items = 0
+            while time.monotonic() < deadline:
+                memory_items = (await client.get(f"{base}/healthz")).json()["tiers"]["memory"]
+                await asyncio.sleep(0.5)
+            rss_warm = read_rss_bytes(service.pid)
+            report["memory"] = {
+                "rss_base_bytes": rss_base,
+                "rss_warm_bytes": rss_warm,
+                "memory_items": memory_items,
+                "bytes_per_item": (rss_warm - rss_base) / memory_items if memory_items else None,
+            }
+
+        results = {"page": [], "img": [], "storage": [], "statuses": Counter()}
+        deadline = time.monotonic() + args.duration
+        await asyncio.gather(*(page_client(client, base, deadline, results) for _ in range(args.clients)))
+        report["page"] = latency_summary(results["page"], args.duration)
+        report["image"] = {
+            kind: latency_summary(results[kind], args.duration) for kind in ("img", "storage")
+        }
+        report["statuses"] = {str(key): value for key, value in results["statuses"].items()}
+
+        upstream = (await client.get(f"{fake_base}/__stats")).json()
+        valid = read_metric((await client.get(f"{base}/metrics")).text, "prnt_candidates_valid_total")
+        report["fetcher"] = {
+            "upstream": upstream,
+            "valid": valid,
+            "yield_per_page_request": valid / upstream["pages"] if upstream.get("pages") else None,
+        }
+        if args.workers == 1:
+            report["egress"] = (await client.get(f"{base}/healthz")).json()["egress"]
+    return report
+
+
+def run(args):
+    fake_port, service_port = free_port(), free_port()
+    fake_base = f"http://127.0.0.1:{fake_port}"
+    base = f"http://127.0.0.1:{service_port}"
+    fake = subprocess.Popen(
+        [
+            sys.executable, str(FAKE_PRNT), "--port", str(fake_port),
+            "--hit-ratio", str(args.hit_ratio),
+            "--latency-ms", str(args.latency_ms),
+            "--image-max-kb", str(args.image_max_kb),
+            "--rate-429", str(args.rate_429),
+            "--ban-page-rate", str(args.ban_page_rate),
+            "--client-rate-limit", str(args.client_rate_limit),
+        ]
+    )
+    proxy = None
+    routes = "direct"
+    if args.egress_proxies:
+        proxy_port = free_port()
+        proxy = subprocess.Popen(
+            [sys.executable, str(FAKE_PROXY), "--base-port", str(proxy_port), "--count", str(args.egress_proxies)]
+        )
+        routes = ",".join(f"http://127.0.0.1:{proxy_port + idx}" for idx in range(args.egress_proxies))
+    with tempfile.TemporaryDirectory(prefix="prnt-bench-") as workdir:
+        os.symlink(REPO_DIR / "templates", Path(workdir) / "templates")
+        env = {
+            **os.environ,
+            "PRNT_BASE_URL": fake_base,
+            "PRNT_RATE_LIMIT": str(args.rate_limit),
+            "PRNT_EGRESS_ROUTES": routes,
+            "WEB_CONCURRENCY": str(args.workers),
+            "LOG_LEVEL": "WARNING",
+        }
+        if args.workers > 1:
+            metrics_dir = Path(workdir) / "metrics"
+            metrics_dir.mkdir()
+            env["PROMETHEUS_MULTIPROC_DIR"] = str(metrics_dir)
+        try:
+            asyncio.run(wait_for(httpx.AsyncClient(), f"{fake_base}/__stats", args.startup_timeout))
+            service_started = time.monotonic()
+            service = subprocess.Popen(
+                [
+                    sys.executable, "-m", "uvicorn", "main:app",
+                    "--app-dir", str(REPO_DIR),
+                    "--port", str(service_port),
+                    "--workers", str(args.workers),
+                    "--log-level", "warning",
+                ],
+                cwd=workdir,
+                env=env,
+            )
+            try:
+                report = asyncio.run(run_scenarios(args, service, service_started, base, fake_base))
+            finally:
+                service.terminate()
+                service.wait(timeout=30)
+        finally:
+            fake.terminate()
+            fake.wait(timeout=10)
+            if proxy is not None:
+                proxy.terminate()
+                proxy.wait(timeout=10)
+    report["config"] = vars(args) | {"output": str(args.output) if args.output else None}
+    return report
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=20, help="seconds of page load")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent page clients")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers; above 1 runs shared mode")
+    parser.add_argument("--warmup", type=float, default=10, help="seconds to let the memory tier fill")
+    parser.add_argument(
+        "--rate-limit", type=int, default=3000, help="PRNT_RATE_LIMIT for the run (production uses 45/min)"
+    )
+    parser.add_argument("--hit-ratio", type=float, default=0.3)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--image-max-kb", type=int, default=400)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--ban-page-rate", type=float, default=0.0)
+    parser.add_argument("--client-rate-limit", type=int, default=0, help="per-address budget of the fake, per minute")
+    parser.add_argument(
+        "--egress-proxies", type=int, default=0, help="route prnt.sc traffic through N local proxies (0 is direct)"
+    )
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--request-timeout", type=float, default=30)
+    parser.add_argument("--output", type=Path, help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,42 @@
+"""Derivative encoding for the process pool in main.py.
+
+Kept apart from main.py because the pool uses spawn: each worker imports the
+module of the function it runs, and this one only needs Pillow.
+"""
+import io
+from typing import Dict, Tuple
+
+try:
+    from PIL import Image as PILImage
+except ImportError:  # main.py checks for Pillow before submitting work
+    PILImage = None
+
+
+def render_image_variants(
+    image_bytes: bytes, fmt: str, widths: Tuple[int, ...], quality: int, max_pixels: int
+) -> Dict[str, bytes]:
+    """Process-pool entry point: encode the full-size and downscaled derivatives."""
+    variants = {}
+    try:
+        with PILImage.open(io.BytesIO(image_bytes)) as img:
+            # save() would keep only the first frame of an animation
+            if img.width * img.height > max_pixels or getattr(img, "is_animated", False):
+                return variants
+            if fmt == "jpeg":
+                img = img.convert("RGB")
+            elif img.mode not in ("RGB", "RGBA", "L"):
+                img = img.convert("RGBA")
+            for width in (None, *widths):
+                if width is None:
+                    frame = img
+                elif width < img.width:
+                    frame = img.resize((width, max(1, round(img.height * width / img.width))), PILImage.LANCZOS)
+                else:
+                    continue
+                encoded = io.BytesIO()
+                frame.save(encoded, fmt.upper(), quality=quality)
+                if encoded.tell() < len(image_bytes):
+                    variants[fmt if width is None else f"w{width}.{fmt}"] = encoded.getvalue()
+    except (OSError, ValueError, PILImage.DecompressionBombError):
+        return {}
+    return variants
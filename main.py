@@ -1,24 +1,61 @@
-import base64
+import asyncio
+import fcntl
+import hashlib
+import io
 import json
+import logging
+import math
 import mimetypes
+import mmap
+import multiprocessing
+import os
+import queue
+import re
 import random
+import secrets
+import sqlite3
 import string
+import sys
 import threading
 import time
-from collections import deque
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from html import unescape
+from logging.handlers import QueueHandler
 from pathlib import Path
-from typing import Optional, Deque, Dict, Any
+from typing import Optional, Deque, Dict, Any, List, AsyncIterator, Callable, Tuple
 from urllib.parse import urlparse
 
-import requests
+import httpx
 from bs4 import BeautifulSoup
-from fastapi import BackgroundTasks, FastAPI, HTTPException, Query, Request
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, PlainTextResponse, Response
 from fastapi.templating import Jinja2Templates
-from requests.adapters import HTTPAdapter
-
-PRNT_BASE_URL = "https://prnt.sc"
+from markupsafe import escape as html_escape
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import REGISTRY as METRICS_REGISTRY
+from prometheus_client import multiprocess
+
+try:
+    from PIL import Image as PILImage
+    from PIL import features as pil_features
+except ImportError:  # Pillow is optional, perceptual hashing and derivatives need it
+    PILImage = None
+    pil_features = None
+
+try:
+    from lxml import etree as lxml_etree
+    from lxml import html as lxml_html
+except ImportError:  # lxml is optional, bs4 covers the fallback
+    lxml_etree = None
+    lxml_html = None
+
+from derivatives import render_image_variants
+
+# overridable so benchmarks can point the service at a local stand-in
+PRNT_BASE_URL = os.environ.get("PRNT_BASE_URL", "https://prnt.sc").rstrip("/")
 
 app = FastAPI(
     title="Prnt.sc Random Screenshot API",
@@ -37,17 +74,58 @@ app.add_middleware(
 
                                                                       
 
-CACHE_MAX_SIZE = 20
+CACHE_MIN_SIZE = 5
+CACHE_MAX_SIZE = 100
 CACHE_PREFILL_TARGET = 20
-CACHE_WORKER_COUNT = 4
-CACHE_REFILL_DELAY_OK = 0.3
-CACHE_REFILL_DELAY_FAIL = 1.5
+# the memory tier is bounded by bytes as well as by the controller's item
+# target; images above MEMORY_TIER_MAX_ITEM_BYTES always go to the disk tier
+MEMORY_TIER_MAX_BYTES = int(os.environ.get("MEMORY_TIER_MAX_BYTES", 64 * 1024 * 1024))
+MEMORY_TIER_MAX_ITEM_BYTES = 1024 * 1024
+FETCH_CONCURRENCY_MAX = 64
+FETCH_ERROR_DELAY = 1.5
+
+# fetching is a three-stage pipeline: resolvers (prnt.sc pages, rate
+# limited) -> downloaders (image hosts, gated per host) -> store workers,
+# connected by bounded queues
+RESOLVED_QUEUE_SIZE = 32
+DOWNLOADED_QUEUE_SIZE = 8
+IMAGE_DOWNLOAD_WORKERS = 16
+IMAGE_STORE_WORKERS = 2
+IMAGE_HOST_CONCURRENCY = 8
+IMAGE_HOST_RATE_LIMIT = 120
+IMAGE_HOST_RATE_WINDOW = 60
+LIVE_FETCH_MAX_ATTEMPTS = 10
 
 DISK_CACHE_DIR = Path("storage/images")
-DISK_CACHE_MAX_ITEMS = 1000
-DISK_IDLE_SLEEP = 5
+DISK_INDEX_PATH = Path("storage/disk_index.sqlite3")
+DISK_INDEX_COLUMNS = "seq, id, file_name, content_type, page_url, original_image_url"
+DISK_CACHE_MAX_ITEMS = int(os.environ.get("DISK_CACHE_MAX_ITEMS", "1000"))
+DISK_CACHE_MIN_TARGET = 50
 DISK_META_SUFFIX = ".json"
 DISK_IMAGE_DEFAULT_SUFFIX = ".bin"
+DISK_TEMP_SUFFIX = ".tmp"
+# the disk tier is written behind by a single thread: queued items are
+# written to temp files, synced once per batch, renamed into place and only
+# then published in the index
+DISK_WRITE_QUEUE_SIZE = 16
+DISK_WRITE_BATCH_MAX = 8
+DISK_WRITE_FSYNC = os.environ.get("DISK_WRITE_FSYNC", "1") != "0"
+DISK_WRITER_STOP_TIMEOUT = 30
+# "files" keeps one file per image in DISK_CACHE_DIR; "segments" appends
+# images to large segment files indexed by (segment, offset, length) and
+# serves mmap slices of them, which scales to far more items per directory.
+# Segments are dropped once every blob in them is gone and compacted when
+# mostly dead; the writer thread owns both.
+DISK_STORAGE_ENGINE = os.environ.get("DISK_STORAGE_ENGINE", "files")
+if DISK_STORAGE_ENGINE not in ("files", "segments"):
+    raise ValueError(f"DISK_STORAGE_ENGINE must be files or segments, not {DISK_STORAGE_ENGINE!r}")
+DISK_SEGMENT_MODE = DISK_STORAGE_ENGINE == "segments"
+DISK_SEGMENT_DIR = Path("storage/segments")
+DISK_SEGMENT_SUFFIX = ".seg"
+DISK_SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+DISK_SEGMENT_COMPACT_RATIO = 0.25
+DISK_SEGMENT_RECLAIM_INTERVAL = 30
+DISK_SEGMENT_MAP_CACHE_SIZE = 64
 
 CONTENT_TYPE_EXTENSIONS = {
     "image/jpeg": ".jpg",
@@ -57,35 +135,515 @@ CONTENT_TYPE_EXTENSIONS = {
     "image/webp": ".webp",
 }
 
-PRNT_RATE_LIMIT = 45
+PRNT_RATE_LIMIT = int(os.environ.get("PRNT_RATE_LIMIT", "45"))
 PRNT_RATE_WINDOW = 60
-PRNT_RATE_SLEEP_SLICE = 0.5
 
-BAN_INTERVAL_SECONDS = 15 * 60
+# prnt.sc requests go out over egress routes, listed in PRNT_EGRESS_ROUTES
+# (comma separated): "direct", proxy URLs (http://, https://, or socks5://
+# with httpx[socks] installed) and "source:<local address>" to bind a
+# specific interface. Every route has its own connection pool, token bucket,
+# AIMD rate and ban state, and is persisted in the broker. Each starts at
+# PRNT_RATE_LIMIT / PRNT_RATE_WINDOW; AIMD adds PRNT_RATE_INCREASE req/s per
+# 2xx page and multiplies by PRNT_RATE_DECREASE on every ban signal, within
+# PRNT_RATE_MIN_FACTOR..PRNT_RATE_MAX_FACTOR of it
+PRNT_EGRESS_ROUTES = [
+    route.strip() for route in os.environ.get("PRNT_EGRESS_ROUTES", "direct").split(",") if route.strip()
+]
+
+
+def is_valid_egress_spec(spec: str) -> bool:
+    if spec == "direct" or (spec.startswith("source:") and spec != "source:"):
+        return True
+    try:
+        parsed = urlparse(spec)
+        parsed.port  # raises on a malformed port
+    except ValueError:
+        return False
+    return parsed.scheme in ("http", "https", "socks5", "socks5h") and bool(parsed.hostname)
+
+
+if not PRNT_EGRESS_ROUTES:
+    raise ValueError("PRNT_EGRESS_ROUTES lists no routes, use direct to go out without a proxy")
+for route_idx, route_spec in enumerate(PRNT_EGRESS_ROUTES):
+    # by position, the entry may hold proxy credentials
+    if not is_valid_egress_spec(route_spec):
+        raise ValueError(
+            f"PRNT_EGRESS_ROUTES entry {route_idx + 1} is not direct, source:<address> or an http(s)/socks5 proxy URL"
+        )
+EGRESS_MAX_CONNECTIONS = 16
+EGRESS_STATE_PERSIST_INTERVAL = 5
+EGRESS_PROBE_CHECK_INTERVAL = 5
+PRNT_RATE_BURST = 5
+PRNT_RATE_INCREASE = 0.002
+PRNT_RATE_DECREASE = 0.5
+PRNT_RATE_MIN_FACTOR = 0.2
+PRNT_RATE_MAX_FACTOR = 2.0
+
+# ban retries back off exponentially (with +-jitter) per consecutive strike;
+# strikes are forgotten after BAN_STRIKE_RESET_SECONDS without a ban
+BAN_BACKOFF_BASE_SECONDS = 60
+BAN_BACKOFF_MAX_SECONDS = 60 * 60
+BAN_BACKOFF_JITTER = 0.2
+BAN_STRIKE_RESET_SECONDS = 6 * 60 * 60
 BAN_NOTICE_TEXT = "Sorry, waiting for prnt.sc to unban us."
 BAN_STATUS_CODES = {403, 429, 503}
 BAN_KEYWORDS = ("temporarily blocked", "access denied", "rate limit")
 
-MAX_IMAGE_SIZE_BYTES = 5 * 1024 * 1024
+# extractors are tried in this order; the fast scanner handles nearly every
+# page, the DOM parsers only run when it comes back empty
+HTML_EXTRACTOR_ORDER = ("fast", "lxml", "bs4")
+PAGE_HEAD_MAX_BYTES = 64 * 1024
 
-cache: Deque[Dict[str, Any]] = deque()
-cache_lock = threading.Lock()
-disk_cache_lock = threading.Lock()
-disk_cache_count = 0
-disk_serving_lock = threading.Lock()
-disk_serving_registry: Dict[str, Dict[str, Any]] = {}
+MAX_IMAGE_SIZE_BYTES = 5 * 1024 * 1024
 
-prnt_rate_lock = threading.Lock()
-prnt_request_times: Deque[float] = deque()
+# uvicorn reads WEB_CONCURRENCY as the default for --workers. With more than
+# one worker the memory tier is disabled: the single elected fetcher process
+# produces into the disk tier and every worker consumes from it.
+WEB_WORKERS = int(os.environ.get("WEB_CONCURRENCY", "1"))
+SHARED_MODE = WEB_WORKERS > 1
+BROKER_DB_PATH = Path("storage/broker.sqlite3")
+BROKER_BUSY_TIMEOUT_MS = 5000
+FETCHER_LOCK_PATH = Path("storage/fetcher.lock")
+FETCHER_ELECTION_INTERVAL = 5
+BAN_STATE_REFRESH_SECONDS = 2
+SHARED_QUEUE_WAIT_SECONDS = 10
+SHARED_QUEUE_POLL_SECONDS = 0.25
+# empty-cache requests queue for the next produced item instead of fetching
+# on their own; past the wait they get a 503 with Retry-After
+ITEM_WAIT_SECONDS = 10
+ITEM_RETRY_AFTER_SECONDS = 5
+
+# /img tokens stay valid for the TTL, not just the first request: nginx
+# caches "/" for a few seconds and serves that page to several visitors
+IMAGE_HANDOFF_MAX_BYTES = 32 * 1024 * 1024
+IMAGE_HANDOFF_TTL_SECONDS = 120
+IMAGE_HANDOFF_CACHE_CONTROL = "private, max-age=120"
+
+# a disk image handed to a client stays on a lease: it survives retries, range
+# requests and revalidation until DISK_LEASE_SECONDS pass or it has been sent
+# in full DISK_LEASE_MAX_SERVES times, then DISK_LEASE_GRACE_SECONDS later
+# the sweeper deletes it. File names are content hashes, so the name is the ETag.
+DISK_LEASE_SECONDS = 300
+DISK_LEASE_MAX_SERVES = 3
+DISK_LEASE_GRACE_SECONDS = 15
+DISK_LEASE_SWEEP_INTERVAL = 10
+DISK_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# the prefetch controller sizes the memory tier, the disk tier target and
+# fetch concurrency so the predicted time-to-empty stays above the SLO
+PREFETCH_CONTROLLER_INTERVAL = 2
+PREFETCH_SLO_SECONDS = 300
+PREFETCH_REFILL_HORIZON_SECONDS = 60
+MEMORY_TIER_SLO_SECONDS = 20
+DEMAND_EWMA_FAST_SECONDS = 30
+DEMAND_PEAK_HALF_LIFE_SECONDS = 6 * 3600
+FETCH_STATS_EWMA_ALPHA = 0.05
+FETCH_SUCCESS_FLOOR = 0.02
+FETCH_CONCURRENCY_HEADROOM = 1.5
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = "%(asctime)s %(levelname)s %(message)s"
+LOG_BATCH_MAX = 256
+
+# /debug/* needs "Authorization: Bearer $ADMIN_TOKEN" and answers 404 while
+# ADMIN_TOKEN is unset. Profiles and lock timing cover the worker process
+# that handles the request.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+PROFILE_MAX_SECONDS = 60
+PROFILE_DEFAULT_INTERVAL_MS = 10
+# innermost frames of threads parked on a lock, a queue or the event loop
+# selector; the last two block in SimpleQueue.get, which has no Python frame
+PROFILE_IDLE_LEAVES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("selectors.py", "select"),
+    ("thread.py", "_worker"),
+    ("main.py", "log_writer_loop"),
+}
+# the named locks time their waits and holds while this is on; it can be
+# switched at runtime through POST /debug/locks
+LOCK_TIMING = os.environ.get("LOCK_TIMING", "0") == "1"
+LOCK_CONTENDED_SECONDS = 0.0001
+
+# candidate IDs are drawn by Thompson sampling over ID prefixes, learning
+# which parts of the ID space actually hold screenshots
+ID_ALPHABET = string.ascii_lowercase + string.digits
+ID_SAMPLER_PREFIX_LEN = 2
+ID_SAMPLER_EXPLORATION = 0.1
+ID_SAMPLER_PRIOR = (1.0, 4.0)
+ID_SAMPLER_STATS_PATH = Path("storage/id_sampler.json")
+ID_SAMPLER_SAVE_INTERVAL = 60
+# outcomes that say nothing about the ID itself
+ID_SAMPLER_TRANSIENT_REASONS = frozenset({"page_error", "image_error", "banned"})
+
+# IDs that already failed are remembered in a timing Bloom filter: each of
+# NEGATIVE_CACHE_HASHES uint16 cells holds an expiry hour, an ID is dead
+# while all of its cells are in the future. 2^24 cells is a 32 MB file
+# with ~2% false positives at a month of full-rate probing.
+NEGATIVE_CACHE_PATH = Path("storage/negative_cache.bin")
+NEGATIVE_CACHE_CELLS = 1 << 24
+NEGATIVE_CACHE_HASHES = 4
+NEGATIVE_CACHE_EPOCH = 1_700_000_000
+NEGATIVE_CACHE_MAX_REDRAWS = 20
+DAY_SECONDS = 24 * 3600
+NEGATIVE_CACHE_TTLS = {
+    "bad_pattern": 30 * DAY_SECONDS,
+    "blocked_domain": 30 * DAY_SECONDS,
+    "too_large": 30 * DAY_SECONDS,
+    "no_img_tag": 7 * DAY_SECONDS,
+    "bad_img_url": 7 * DAY_SECONDS,
+    "image_non_200": 7 * DAY_SECONDS,
+    "non_image": 7 * DAY_SECONDS,
+    "html_body": 7 * DAY_SECONDS,
+    "page_non_200": DAY_SECONDS,
+    "empty_image": DAY_SECONDS,
+    "placeholder": 30 * DAY_SECONDS,
+    "duplicate": 30 * DAY_SECONDS,
+    "near_duplicate": 30 * DAY_SECONDS,
+}
 
-prnt_ban_lock = threading.Lock()
+# downloaded images are deduplicated by a content hash (exact) and a 64-bit
+# dHash (near duplicates within PHASH_MAX_DISTANCE bits). Bytes seen behind
+# PLACEHOLDER_MIN_REPEATS different IDs are treated as a placeholder image.
+DEDUP_PERCEPTUAL = True
+DEDUP_RETENTION_SECONDS = 90 * DAY_SECONDS
+PHASH_SIZE = 8
+PHASH_MAX_DISTANCE = 4
+# PHASH_MAX_DISTANCE + 1 bands, so a near duplicate shares at least one band
+PHASH_BAND_LAYOUT = ((0, 0x1FFF), (13, 0x1FFF), (26, 0x1FFF), (39, 0x1FFF), (52, 0xFFF))
+PLACEHOLDER_MIN_REPEATS = 3
+KNOWN_PLACEHOLDER_HASHES: frozenset = frozenset()
+
+# every accepted image is re-encoded in a process pool into DERIVATIVE_FORMAT,
+# at full size and at each of DERIVATIVE_WIDTHS; a variant is kept only when
+# it is smaller than the original. /storage and /img pick one per request
+# from the Accept header and ?w=
+DERIVATIVE_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+DERIVATIVE_FORMAT = "webp" if pil_features is not None and pil_features.check("webp") else "jpeg"
+DERIVATIVE_WIDTHS = (640,)
+DERIVATIVE_QUALITY = 80
+DERIVATIVE_MAX_PIXELS = 40_000_000
+# the page asks for this width on narrow screens through preview_url
+PREVIEW_WIDTH = min(DERIVATIVE_WIDTHS)
+
+HTTP_TIMEOUT = 5
+HTTP_MAX_CONNECTIONS = 64
+
+
+class Screenshot:
+    """One screenshot on its way through the pipeline and the cache tiers."""
+
+    __slots__ = (
+        "id",
+        "page_url",
+        "original_image_url",
+        "content_type",
+        "image_bytes",
+        "content_hash",
+        "disk_file_name",
+        "variants",
+    )
+
+    def __init__(
+        self,
+        prnt_id: str,
+        page_url: str,
+        original_image_url: Optional[str] = None,
+        content_type: str = "",
+        image_bytes: Optional[memoryview] = None,
+        content_hash: Optional[str] = None,
+        disk_file_name: Optional[str] = None,
+        variants: Optional[Dict[str, bytes]] = None,
+    ):
+        self.id = prnt_id
+        self.page_url = page_url
+        self.original_image_url = original_image_url
+        self.content_type = content_type
+        self.image_bytes = image_bytes
+        self.content_hash = content_hash
+        self.disk_file_name = disk_file_name
+        # derivative key ("webp", "w640.webp", ...) -> encoded bytes
+        self.variants = variants
+
+    @property
+    def size(self) -> int:
+        size = len(self.image_bytes) if self.image_bytes is not None else 0
+        if self.variants:
+            size += sum(len(data) for data in self.variants.values())
+        return size
+
+
+class EgressRoute:
+    """One way out to prnt.sc, with its own client, token bucket and ban state."""
+
+    __slots__ = (
+        "spec",
+        "name",
+        "state_key",
+        "client",
+        "rate",
+        "tokens",
+        "tokens_at",
+        "in_flight",
+        "ban_active",
+        "next_retry_ts",
+        "ban_reason",
+        "ban_strikes",
+        "last_ban_at",
+    )
+
+    def __init__(self, spec: str, client: Optional[httpx.AsyncClient] = None):
+        self.spec = spec
+        # proxy credentials never reach logs, metric labels or the broker
+        self.name = describe_egress_route(spec)
+        self.state_key = hashlib.sha256(spec.encode()).hexdigest()[:16]
+        self.client = client
+        self.rate = base_prnt_rate()
+        # a fresh bucket starts empty, the burst has to be earned
+        self.tokens = 0.0
+        self.tokens_at = time.time()
+        self.in_flight = 0
+        self.ban_active = False
+        self.next_retry_ts = 0.0
+        self.ban_reason = ""
+        self.ban_strikes = 0
+        self.last_ban_at = 0.0
+
+
+class TimedLock:
+    """A threading.Lock that records wait and hold times while lock timing is on."""
+
+    __slots__ = ("name", "lock", "acquired_at")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.acquired_at = 0.0
+
+    def __enter__(self):
+        if not lock_timing_enabled:
+            self.lock.acquire()
+            self.acquired_at = 0.0
+            return self
+        started = time.perf_counter()
+        self.lock.acquire()
+        self.acquired_at = time.perf_counter()
+        record_lock_wait(self.name, self.acquired_at - started)
+        return self
+
+    def __exit__(self, *exc_info):
+        # read before releasing, the next holder overwrites it
+        acquired_at = self.acquired_at
+        self.lock.release()
+        if acquired_at:
+            record_lock_hold(self.name, time.perf_counter() - acquired_at)
+
+
+class TimedAsyncLock(TimedLock):
+    """The asyncio.Lock counterpart of TimedLock, for event loop locks."""
+
+    __slots__ = ()
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        if not lock_timing_enabled:
+            await self.lock.acquire()
+            self.acquired_at = 0.0
+            return self
+        started = time.perf_counter()
+        await self.lock.acquire()
+        self.acquired_at = time.perf_counter()
+        record_lock_wait(self.name, self.acquired_at - started)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.__exit__(*exc_info)
+
+
+lock_timing_enabled = LOCK_TIMING
+lock_stats_lock = threading.Lock()
+# lock name -> acquisitions, contended, wait/hold totals and maxima
+lock_stats: Dict[str, Dict[str, float]] = {}
+profile_running = False
+
+cache: Deque[Screenshot] = deque()
+cache_bytes = 0
+cache_lock = TimedLock("cache")
+disk_cache_lock = TimedLock("disk_cache")
+disk_cache_count = 0
+disk_write_lock = TimedLock("disk_write")
+disk_write_queue: "queue.Queue[Optional[Tuple[str, Screenshot]]]" = queue.Queue(maxsize=DISK_WRITE_QUEUE_SIZE)
+# file names queued or being written, counted as disk stock
+disk_write_pending = set()
+disk_writer_thread: Optional[threading.Thread] = None
+# the segment being appended to, only touched by the writer thread
+segment_active_id: Optional[int] = None
+segment_active_file = None
+segment_active_size = 0
+segment_maps_lock = TimedLock("segment_maps")
+segment_maps: "OrderedDict[int, mmap.mmap]" = OrderedDict()
+# FIFO mirror of the disk_items table, oldest entry first
+disk_index: Deque[Dict[str, Any]] = deque()
+disk_index_ids = set()
+disk_index_conn: Optional[sqlite3.Connection] = None
+image_handoff_lock = TimedLock("image_handoff")
+image_handoff_table: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+image_handoff_bytes = 0
+
+broker_lock = TimedLock("broker")
+broker_conn: Optional[sqlite3.Connection] = None
+fetcher_lock_file = None
+is_fetcher_process = False
+# set once the fetcher has loaded its state; until then it serves like a consumer
+fetcher_ready = False
+# why fetcher startup failed; the process then gives up the fetcher role
+fetcher_error: Optional[str] = None
+
+# asyncio primitives below are only ever touched from the uvicorn event loop
+egress_routes: List[EgressRoute] = []
+# page requests queue on egress_lock in FIFO order for a route with a token;
+# egress_changed wakes them when a route is unbanned
+egress_lock = TimedAsyncLock("egress")
+egress_changed = asyncio.Event()
+# set when a route's ban state changes, so it is saved without waiting out
+# EGRESS_STATE_PERSIST_INTERVAL
+egress_state_dirty = asyncio.Event()
+
+# aggregate over the routes: banned only while every route is banned
 prnt_ban_active = False
 prnt_next_retry_ts = 0.0
 prnt_ban_reason = ""
+prnt_ban_checked_at = 0.0
+
+prefetch_condition = asyncio.Condition()
+prefetch_tick_event = asyncio.Event()
+memory_tier_target = CACHE_PREFILL_TARGET
+disk_tier_target = DISK_CACHE_MIN_TARGET
+fetch_concurrency_target = 1
+demand_rate_fast = 0.0
+demand_rate_peak = 0.0
+demand_stock_prev = 0
+demand_stored_since_tick = 0
+fetch_success_ewma = 0.1
+page_latency_ewma = 1.0
+image_latency_ewma = 1.0
+
+# FIFO of requests waiting on an empty cache, served before any tier
+item_waiters: "Deque[asyncio.Future[Screenshot]]" = deque()
+
+resolved_queue: "asyncio.Queue[Screenshot]" = asyncio.Queue(maxsize=RESOLVED_QUEUE_SIZE)
+downloaded_queue: "asyncio.Queue[Screenshot]" = asyncio.Queue(maxsize=DOWNLOADED_QUEUE_SIZE)
+image_host_gates: Dict[str, Dict[str, Any]] = {}
+derivative_pool: Optional[ProcessPoolExecutor] = None
+
+http_client: Optional[httpx.AsyncClient] = None
+fetch_tasks: List[asyncio.Task] = []
+
+id_sampler_lock = TimedLock("id_sampler")
+# prefix -> [valid, invalid] outcome counts
+id_sampler_stats: Dict[str, List[int]] = {}
+id_sampler_dirty = False
+
+dedup_lock = TimedLock("dedup")
+dedup_conn: Optional[sqlite3.Connection] = None
+dedup_content_hashes = set()
+dedup_placeholders = set()
+dedup_phash_bands: List[Dict[int, List[int]]] = [{} for _ in PHASH_BAND_LAYOUT]
+
+negative_cache_file = None
+negative_cache_map: Optional[mmap.mmap] = None
+negative_cache_cells: Optional[memoryview] = None
+
+# --- logging: records are queued on the hot path and written in batches by
+# a background thread, so request handlers never block on stdout
+
+log = logging.getLogger("prnt")
+log_queue: "queue.SimpleQueue[Optional[logging.LogRecord]]" = queue.SimpleQueue()
+log_writer_thread: Optional[threading.Thread] = None
+
+
+def log_writer_loop():
+    formatter = logging.Formatter(LOG_FORMAT)
+    while True:
+        batch = [log_queue.get()]
+        while len(batch) < LOG_BATCH_MAX:
+            try:
+                batch.append(log_queue.get_nowait())
+            except queue.Empty:
+                break
+        lines = [formatter.format(record) for record in batch if record is not None]
+        if lines:
+            sys.stdout.write("\n".join(lines) + "\n")
+            sys.stdout.flush()
+        if None in batch:
+            return
+
+
+def init_logging():
+    global log_writer_thread
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
+    log.addHandler(QueueHandler(log_queue))
+    log_writer_thread = threading.Thread(target=log_writer_loop, name="log-writer", daemon=True)
+    log_writer_thread.start()
+
+
+def flush_logging():
+    if log_writer_thread is not None and log_writer_thread.is_alive():
+        log_queue.put(None)
+        log_writer_thread.join(timeout=2)
+
+
+init_logging()
+
+# --- metrics
+
+CANDIDATES_TOTAL = Counter("prnt_candidates_total", "prnt.sc IDs tried")
+CANDIDATE_REJECTIONS = Counter(
+    "prnt_candidate_rejections_total", "Candidates rejected, by reason", ["reason"]
+)
+PAGE_FETCH_SECONDS = Histogram("prnt_page_fetch_seconds", "prnt.sc page fetch latency")
+IMAGE_FETCH_SECONDS = Histogram("prnt_image_fetch_seconds", "Screenshot download latency")
+RATE_LIMIT_WAIT_SECONDS = Histogram(
+    "prnt_rate_limit_wait_seconds",
+    "Time spent waiting for a prnt.sc rate-limit slot",
+    buckets=(0.001, 0.01, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300),
+)
+BAN_TRANSITIONS = Counter("prnt_ban_transitions_total", "Ban state changes", ["route", "state"])
+PRNT_RATE = Gauge(
+    "prnt_rate_limit_per_second", "Current adaptive prnt.sc request rate", ["route"], multiprocess_mode="livemax"
+)
+EGRESS_BANNED = Gauge("prnt_egress_banned", "1 while an egress route is banned", ["route"], multiprocess_mode="livemax")
+TIER_ITEMS = Gauge("prnt_tier_items", "Items ready in each cache tier", ["tier"], multiprocess_mode="livemax")
+TIER_BYTES = Gauge("prnt_tier_bytes", "Image bytes held in each cache tier", ["tier"], multiprocess_mode="livemax")
+PIPELINE_QUEUE_ITEMS = Gauge(
+    "prnt_pipeline_queue_items", "Items waiting between fetch pipeline stages", ["queue"], multiprocess_mode="livemax"
+)
+PREFETCH_TARGETS = Gauge(
+    "prnt_prefetch_target", "Targets chosen by the prefetch controller", ["kind"], multiprocess_mode="livemax"
+)
+CANDIDATES_VALID = Counter("prnt_candidates_valid_total", "prnt.sc IDs that produced a usable screenshot")
+FETCH_YIELD = Gauge(
+    "prnt_fetch_yield", "Smoothed valid screenshots per upstream candidate", multiprocess_mode="livemax"
+)
+NEGATIVE_CACHE_SKIPS = Counter("prnt_negative_cache_skips_total", "Candidate IDs skipped as known dead")
+SERVED_TOTAL = Counter("prnt_served_total", "Screenshots handed out, by source", ["source"])
+ROOT_RENDER_SECONDS = Histogram("prnt_root_render_seconds", "Latency of the / endpoint")
+LOCK_WAIT_SECONDS = Histogram(
+    "prnt_lock_wait_seconds",
+    "Time spent waiting for a named lock, while lock timing is on",
+    ["lock"],
+    buckets=(0.00001, 0.0001, 0.001, 0.01, 0.1, 1, 10),
+)
+
 
-SESSION = requests.Session()
-SESSION.mount("https://", HTTPAdapter(pool_connections=64, pool_maxsize=64))
-SESSION.mount("http://", HTTPAdapter(pool_connections=64, pool_maxsize=64))
+def reject_candidate(prnt_id: str, reason: str):
+    CANDIDATE_REJECTIONS.labels(reason).inc()
+    record_id_outcome(prnt_id, reason)
+    remember_negative_id(prnt_id, reason)
 
 COMMON_HEADERS = {
     "User-Agent": (
@@ -185,69 +743,374 @@ LANGUAGE_TEXT = {
 }
 
 DEFAULT_LANG = "en"
+# /api/random/batch, used by the page to preload the next few screenshots
+API_BATCH_DEFAULT = 3
+API_BATCH_MAX = 10
+PAGE_EMOJI_LIST = ["✨", "⚡️", "🌠", "🎲", "🎯", "🚀", "🌈", "🌀", "💫"]
 
 templates = Jinja2Templates(directory="templates")
 templates.env.auto_reload = True
 
+# "/" is rendered once per (language, ban banner) into static byte chunks with
+# slots for the per-request fields; the template file is re-checked at most
+# every PAGE_TEMPLATE_CHECK_SECONDS
+PAGE_TEMPLATE_NAME = "show_random.html"
+PAGE_TEMPLATE_CHECK_SECONDS = 2
+PAGE_SLOTS = ("image_url", "preview_url", "id", "page_url")
+PAGE_SLOT_PATTERN = re.compile("\x00(" + "|".join(PAGE_SLOTS) + ")\x00")
+page_templates: Dict[Tuple[str, bool], List[Any]] = {}
+page_template_mtime = 0.0
+page_template_checked_at = 0.0
+
+
+def open_disk_index() -> sqlite3.Connection:
+    conn = sqlite3.connect(str(DISK_INDEX_PATH), isolation_level=None, check_same_thread=False)
+    conn.execute(f"PRAGMA busy_timeout={BROKER_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS disk_items (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL UNIQUE,
+            file_name TEXT NOT NULL,
+            content_type TEXT NOT NULL,
+            page_url TEXT NOT NULL,
+            original_image_url TEXT,
+            saved_at REAL NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS segment_blobs (
+            name TEXT PRIMARY KEY,
+            stem TEXT NOT NULL,
+            segment INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS segment_blobs_stem ON segment_blobs (stem)")
+    conn.execute("CREATE INDEX IF NOT EXISTS segment_blobs_segment ON segment_blobs (segment)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS disk_leases (
+            file_name TEXT PRIMARY KEY,
+            content_type TEXT NOT NULL,
+            serves_left INTEGER NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        """
+    )
+    return conn
+
+
+def import_legacy_disk_meta(conn: sqlite3.Connection):
+    # one-off migration of the per-item .json files used before the index
+    legacy = sorted(DISK_CACHE_DIR.glob(f"*{DISK_META_SUFFIX}"), key=lambda p: p.stat().st_mtime)
+    for meta_path in legacy:
+        try:
+            meta = json.loads(meta_path.read_text())
+            conn.execute(
+                "INSERT OR IGNORE INTO disk_items "
+                "(id, file_name, content_type, page_url, original_image_url, saved_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    meta["id"],
+                    meta.get("file_name") or f"{meta['id']}{DISK_IMAGE_DEFAULT_SUFFIX}",
+                    meta.get("content_type", "image/png"),
+                    meta["page_url"],
+                    meta.get("original_image_url"),
+                    meta.get("saved_at") or meta_path.stat().st_mtime,
+                ),
+            )
+        except (OSError, KeyError, json.JSONDecodeError) as exc:
+            log.warning("[disk] dropping legacy meta %s: %s", meta_path.name, exc)
+        meta_path.unlink(missing_ok=True)
+    if legacy:
+        log.info("[disk] imported %d legacy meta files into the index", len(legacy))
+
+
+def disk_entry_from_row(row) -> Dict[str, Any]:
+    seq, item_id, file_name, content_type, page_url, original_image_url = row
+    return {
+        "seq": seq,
+        "id": item_id,
+        "file_name": file_name,
+        "content_type": content_type,
+        "page_url": page_url,
+        "original_image_url": original_image_url,
+    }
+
 
 def init_disk_cache_dir():
-    global disk_cache_count
+    global disk_index_conn
     DISK_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    if DISK_SEGMENT_MODE:
+        DISK_SEGMENT_DIR.mkdir(parents=True, exist_ok=True)
     with disk_cache_lock:
-        valid_files = set()
-        for meta_path in DISK_CACHE_DIR.glob(f"*{DISK_META_SUFFIX}"):
-            try:
-                meta = json.loads(meta_path.read_text())
-            except (OSError, json.JSONDecodeError):
-                meta_path.unlink(missing_ok=True)
+        if disk_index_conn is None:
+            disk_index_conn = open_disk_index()
+    # in shared mode the elected fetcher reconciles, other workers must not
+    # delete files the fetcher is still writing
+    if not SHARED_MODE:
+        reconcile_disk_index()
+
+
+def reconcile_disk_index():
+    global disk_cache_count
+    with disk_cache_lock:
+        import_legacy_disk_meta(disk_index_conn)
+        on_disk = set()
+        partial_writes = 0
+        if DISK_SEGMENT_MODE:
+            partial_writes = recover_segments()
+            on_disk = {name for (name,) in disk_index_conn.execute("SELECT name FROM segment_blobs")}
+        else:
+            for entry in os.scandir(DISK_CACHE_DIR):
+                if not entry.is_file():
+                    continue
+                # a temp file is a write that never reached its rename, so the
+                # index cannot reference it
+                if entry.name.startswith(".") and entry.name.endswith(DISK_TEMP_SUFFIX):
+                    Path(entry.path).unlink(missing_ok=True)
+                    partial_writes += 1
+                    continue
+                on_disk.add(entry.name)
+        disk_index.clear()
+        disk_index_ids.clear()
+        stale_seqs = []
+        valid_count = 0
+        rows = disk_index_conn.execute(f"SELECT {DISK_INDEX_COLUMNS} FROM disk_items ORDER BY seq")
+        for row in rows:
+            entry = disk_entry_from_row(row)
+            if entry["file_name"] not in on_disk:
+                stale_seqs.append((entry["seq"],))
                 continue
-            file_name = meta.get("file_name") or f"{meta.get('id')}{DISK_IMAGE_DEFAULT_SUFFIX}"
-            image_path = DISK_CACHE_DIR / file_name
-            if image_path.exists():
-                valid_files.add(file_name)
+            on_disk.discard(entry["file_name"])
+            valid_count += 1
+            if not SHARED_MODE:
+                disk_index.append(entry)
+                disk_index_ids.add(entry["id"])
+        if stale_seqs:
+            disk_index_conn.executemany("DELETE FROM disk_items WHERE seq = ?", stale_seqs)
+        stale_leases = []
+        for (file_name,) in disk_index_conn.execute("SELECT file_name FROM disk_leases").fetchall():
+            if file_name in on_disk:
+                on_disk.discard(file_name)
             else:
-                meta_path.unlink(missing_ok=True)
-        for file_path in DISK_CACHE_DIR.iterdir():
-            if not file_path.is_file():
-                continue
-            if file_path.suffix == DISK_META_SUFFIX:
+                stale_leases.append((file_name,))
+        if stale_leases:
+            disk_index_conn.executemany("DELETE FROM disk_leases WHERE file_name = ?", stale_leases)
+        # derivatives share the stem of a live original
+        live_stems = {
+            file_name.split(".", 1)[0]
+            for (file_name,) in disk_index_conn.execute(
+                "SELECT file_name FROM disk_items UNION SELECT file_name FROM disk_leases"
+            )
+        }
+        for file_name in list(on_disk):
+            if file_name.split(".", 1)[0] in live_stems:
+                on_disk.discard(file_name)
+        if DISK_SEGMENT_MODE:
+            disk_index_conn.executemany("DELETE FROM segment_blobs WHERE name = ?", [(name,) for name in on_disk])
+        else:
+            for file_name in on_disk:
+                (DISK_CACHE_DIR / file_name).unlink(missing_ok=True)
+        disk_cache_count = valid_count
+        log.info(
+            "[disk] index loaded: %d items, %d stale rows, %d orphan files, %d partial writes",
+            valid_count,
+            len(stale_seqs),
+            len(on_disk),
+            partial_writes,
+        )
+
+
+def segment_path(segment_id: int) -> Path:
+    return DISK_SEGMENT_DIR / f"{segment_id:08d}{DISK_SEGMENT_SUFFIX}"
+
+
+def list_segment_ids() -> List[int]:
+    segment_ids = []
+    for entry in os.scandir(DISK_SEGMENT_DIR):
+        stem, _, suffix = entry.name.partition(".")
+        if f".{suffix}" == DISK_SEGMENT_SUFFIX and stem.isdigit():
+            segment_ids.append(int(stem))
+    return sorted(segment_ids)
+
+
+def recover_segments() -> int:
+    """Drop blobs whose bytes are gone and cut off appends that never committed.
+
+    Returns how many segments had an uncommitted tail. Caller holds
+    disk_cache_lock; runs before the writer thread starts.
+    """
+    sizes = {segment_id: segment_path(segment_id).stat().st_size for segment_id in list_segment_ids()}
+    ends = dict(
+        disk_index_conn.execute("SELECT segment, MAX(offset + length) FROM segment_blobs GROUP BY segment").fetchall()
+    )
+    lost = [(segment_id,) for segment_id, end in ends.items() if sizes.get(segment_id, -1) < end]
+    if lost:
+        log.warning("[disk] %d segments are missing or short, dropping their blobs", len(lost))
+        disk_index_conn.executemany("DELETE FROM segment_blobs WHERE segment = ?", lost)
+    truncated = 0
+    if sizes:
+        # only the newest segment is ever appended to
+        newest = max(sizes)
+        end = 0 if (newest,) in lost else ends.get(newest, 0)
+        if sizes[newest] > end:
+            os.truncate(segment_path(newest), end)
+            truncated += 1
+    return truncated
+
+
+def locate_segment_blob(name: str) -> Optional[Tuple[int, int, int]]:
+    # caller holds disk_cache_lock
+    return disk_index_conn.execute(
+        "SELECT segment, offset, length FROM segment_blobs WHERE name = ?", (name,)
+    ).fetchone()
+
+
+def get_segment_map(segment_id: int, end: int) -> mmap.mmap:
+    with segment_maps_lock:
+        segment_map = segment_maps.get(segment_id)
+        # the active segment grows, so an older map may stop short of the blob
+        if segment_map is not None and len(segment_map) >= end:
+            segment_maps.move_to_end(segment_id)
+            return segment_map
+    with open(segment_path(segment_id), "rb") as segment_file:
+        segment_map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+    with segment_maps_lock:
+        segment_maps[segment_id] = segment_map
+        segment_maps.move_to_end(segment_id)
+        # evicted maps are unmapped once the last response slicing them is sent
+        while len(segment_maps) > DISK_SEGMENT_MAP_CACHE_SIZE:
+            segment_maps.popitem(last=False)
+    return segment_map
+
+
+def drop_segment_map(segment_id: int):
+    with segment_maps_lock:
+        segment_maps.pop(segment_id, None)
+
+
+def disk_blob_view(name: str) -> Optional[memoryview]:
+    """Zero-copy view of a blob in its segment, served from the page cache."""
+    for _ in range(2):
+        with disk_cache_lock:
+            location = locate_segment_blob(name)
+        if location is None:
+            return None
+        segment_id, offset, length = location
+        try:
+            segment_map = get_segment_map(segment_id, offset + length)
+        except FileNotFoundError:
+            # compacted away between the lookup and the open, look it up again
+            continue
+        return memoryview(segment_map)[offset : offset + length]
+    return None
+
+
+def disk_blob_exists(name: str) -> bool:
+    if DISK_SEGMENT_MODE:
+        with disk_cache_lock:
+            return locate_segment_blob(name) is not None
+    return (DISK_CACHE_DIR / name).exists()
+
+
+def read_disk_family(file_name: str) -> Tuple[memoryview, Dict[str, bytes]]:
+    """Copy an original and its derivatives out of the disk tier."""
+    variants = {}
+    if DISK_SEGMENT_MODE:
+        stem = file_name.split(".", 1)[0]
+        with disk_cache_lock:
+            rows = disk_index_conn.execute("SELECT name FROM segment_blobs WHERE stem = ?", (stem,)).fetchall()
+        names = [name for (name,) in rows]
+        image_buffer = None
+        for name in names:
+            view = disk_blob_view(name)
+            if view is None:
                 continue
-            if file_path.name not in valid_files:
-                file_path.unlink(missing_ok=True)
-        disk_cache_count = len(valid_files)
+            if name == file_name:
+                image_buffer = bytearray(view)
+            else:
+                variants[name.split(".", 1)[1]] = bytes(view)
+        if image_buffer is None:
+            raise FileNotFoundError(file_name)
+        return memoryview(image_buffer).toreadonly(), variants
+    file_path = DISK_CACHE_DIR / file_name
+    with open(file_path, "rb") as image_file:
+        image_buffer = bytearray(os.fstat(image_file.fileno()).st_size)
+        image_file.readinto(image_buffer)
+    for path in disk_file_family(file_name):
+        if path != file_path:
+            variants[path.name.split(".", 1)[1]] = path.read_bytes()
+    return memoryview(image_buffer).toreadonly(), variants
 
 
 def get_disk_cache_count() -> int:
-    with disk_cache_lock:
-        return disk_cache_count
+    if SHARED_MODE:
+        with disk_cache_lock:
+            count = disk_index_conn.execute("SELECT COUNT(*) FROM disk_items").fetchone()[0]
+        return count + len(disk_write_pending)
+    # the counter only changes under disk_cache_lock and reading an int is
+    # atomic, so the hot path never waits for the lock
+    return disk_cache_count + len(disk_write_pending)
 
 
-def determine_disk_file_name(item: Dict[str, Any]) -> str:
-    content_type = (item.get("content_type") or "").split(";")[0].lower()
+def determine_disk_file_name(item: Screenshot) -> str:
+    content_type = (item.content_type or "").split(";")[0].lower()
     suffix = CONTENT_TYPE_EXTENSIONS.get(content_type, DISK_IMAGE_DEFAULT_SUFFIX)
     if not suffix.startswith("."):
         suffix = f".{suffix}"
-    return f"{item['id']}{suffix}"
+    # content-addressed, so identical bytes can never occupy two files
+    return f"{item.content_hash or item.id}{suffix}"
 
 
-def register_disk_file_inflight(file_name: str, content_type: str):
-    with disk_serving_lock:
-        disk_serving_registry[file_name] = {
-            "path": str(DISK_CACHE_DIR / file_name),
-            "content_type": content_type or "image/png",
-        }
+def lease_disk_file(file_name: str, content_type: str):
+    # caller holds disk_cache_lock
+    disk_index_conn.execute(
+        "INSERT OR REPLACE INTO disk_leases (file_name, content_type, serves_left, expires_at) VALUES (?, ?, ?, ?)",
+        (file_name, content_type or "image/png", DISK_LEASE_MAX_SERVES, time.time() + DISK_LEASE_SECONDS),
+    )
 
 
-def mark_disk_file_served(file_name: str):
-    with disk_serving_lock:
-        disk_serving_registry.pop(file_name, None)
-    file_path = DISK_CACHE_DIR / file_name
-    try:
-        file_path.unlink(missing_ok=True)
-    finally:
-        with disk_cache_lock:
-            global disk_cache_count
-            disk_cache_count = max(0, disk_cache_count - 1)
+def consume_disk_lease(file_name: str) -> Optional[str]:
+    """Count one full response against a lease; returns its content type if leased."""
+    now = time.time()
+    with disk_cache_lock:
+        rows = disk_index_conn.execute(
+            "UPDATE disk_leases SET serves_left = serves_left - 1, "
+            "expires_at = CASE WHEN serves_left <= 1 THEN MIN(expires_at, ?) ELSE expires_at END "
+            "WHERE file_name = ? RETURNING content_type",
+            (now + DISK_LEASE_GRACE_SECONDS, file_name),
+        ).fetchall()
+    return rows[0][0] if rows else None
+
+
+def expire_disk_leases() -> int:
+    with disk_cache_lock:
+        rows = disk_index_conn.execute(
+            "DELETE FROM disk_leases WHERE expires_at < ? RETURNING file_name", (time.time(),)
+        ).fetchall()
+    for (file_name,) in rows:
+        remove_disk_file_family(file_name)
+    return len(rows)
+
+
+async def disk_lease_sweep_loop():
+    while True:
+        await asyncio.sleep(DISK_LEASE_SWEEP_INTERVAL)
+        try:
+            expired = await asyncio.to_thread(expire_disk_leases)
+        except sqlite3.Error as exc:
+            log.error("[disk] lease sweep failed: %s", exc)
+            continue
+        if expired:
+            log.debug("[disk] released %d leased files", expired)
 
 
 def guess_content_type_from_name(file_name: str, default: str = "image/png") -> str:
@@ -255,6 +1118,26 @@ def guess_content_type_from_name(file_name: str, default: str = "image/png") ->
     return content_type or default
 
 
+def disk_variant_name(file_name: str, key: str) -> str:
+    return f"{file_name.split('.', 1)[0]}.{key}"
+
+
+def disk_file_family(file_name: str) -> List[Path]:
+    """The original and all derivatives stored for it."""
+    stem = file_name.split(".", 1)[0]
+    return [path for path in DISK_CACHE_DIR.glob(f"{stem}.*") if path.name.split(".", 1)[0] == stem]
+
+
+def remove_disk_file_family(file_name: str):
+    if DISK_SEGMENT_MODE:
+        # the bytes stay in their segment until it is reclaimed
+        with disk_cache_lock:
+            disk_index_conn.execute("DELETE FROM segment_blobs WHERE stem = ?", (file_name.split(".", 1)[0],))
+        return
+    for path in disk_file_family(file_name):
+        path.unlink(missing_ok=True)
+
+
 def sanitize_disk_file_name(file_name: str) -> Optional[str]:
     candidate = Path(file_name).name
     if candidate != file_name or candidate.startswith("."):
@@ -262,136 +1145,716 @@ def sanitize_disk_file_name(file_name: str) -> Optional[str]:
     return candidate
 
 
-def save_item_to_disk(item: Dict[str, Any]) -> bool:
-    if not item or not item.get("image_bytes"):
+def save_item_to_disk(item: Screenshot) -> bool:
+    """Queue item for the disk writer; True once the disk tier has taken it.
+
+    Blocks while the write queue is full, which backpressures the callers.
+    """
+    if not item or not item.image_bytes:
         return False
-    with disk_cache_lock:
-        global disk_cache_count
-        if disk_cache_count >= DISK_CACHE_MAX_ITEMS:
-            return False
-        meta_path = DISK_CACHE_DIR / f"{item['id']}{DISK_META_SUFFIX}"
-        file_name = determine_disk_file_name(item)
-        data_path = DISK_CACHE_DIR / file_name
-        if meta_path.exists() or data_path.exists():
+    file_name = determine_disk_file_name(item)
+    if item.id in disk_index_ids or disk_blob_exists(file_name):
+        return False
+    with disk_write_lock:
+        if file_name in disk_write_pending or get_disk_cache_count() >= DISK_CACHE_MAX_ITEMS:
             return False
+        disk_write_pending.add(file_name)
+        ensure_disk_writer()
+    disk_write_queue.put((file_name, item))
+    return True
+
+
+def ensure_disk_writer():
+    # caller holds disk_write_lock
+    global disk_writer_thread
+    if disk_writer_thread is None or not disk_writer_thread.is_alive():
+        disk_writer_thread = threading.Thread(target=disk_writer_loop, name="disk-writer", daemon=True)
+        disk_writer_thread.start()
+
+
+def stop_disk_writer():
+    """Write out everything still queued, then stop the writer thread."""
+    with disk_write_lock:
+        thread = disk_writer_thread
+    if thread is not None and thread.is_alive():
+        disk_write_queue.put(None)
+        thread.join(timeout=DISK_WRITER_STOP_TIMEOUT)
+
+
+def disk_writer_loop():
+    reclaimed_at = time.monotonic()
+    while True:
         try:
-            data_path.write_bytes(item["image_bytes"])
-            meta = {
-                "id": item["id"],
-                "page_url": item["page_url"],
-                "content_type": item["content_type"],
-                "original_image_url": item.get("original_image_url"),
-                "saved_at": time.time(),
-                "file_name": file_name,
-            }
-            meta_path.write_text(json.dumps(meta))
-            disk_cache_count += 1
-            print(f"[disk] stored id={item['id']}, disk_size={disk_cache_count}")
-            return True
+            batch = [disk_write_queue.get(timeout=DISK_SEGMENT_RECLAIM_INTERVAL if DISK_SEGMENT_MODE else None)]
+        except queue.Empty:
+            batch = []
+        while batch and len(batch) < DISK_WRITE_BATCH_MAX:
+            try:
+                batch.append(disk_write_queue.get_nowait())
+            except queue.Empty:
+                break
+        jobs = [job for job in batch if job is not None]
+        if jobs:
+            try:
+                write_disk_batch(jobs)
+            except Exception as exc:
+                log.exception("[disk] writer error: %s", exc)
+            finally:
+                with disk_write_lock:
+                    for file_name, _ in jobs:
+                        disk_write_pending.discard(file_name)
+        if DISK_SEGMENT_MODE and time.monotonic() - reclaimed_at >= DISK_SEGMENT_RECLAIM_INTERVAL:
+            try:
+                reclaim_segments()
+            except (OSError, sqlite3.Error) as exc:
+                log.error("[disk] segment reclaim failed: %s", exc)
+            reclaimed_at = time.monotonic()
+        if None in batch:
+            if DISK_SEGMENT_MODE:
+                close_active_segment()
+            return
+
+
+def fsync_paths(paths: List[Path]):
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def disk_family_blobs(file_name: str, item: Screenshot) -> List[Tuple[str, Any]]:
+    # derivatives land before the original, so a servable original always
+    # has its variants next to it
+    names = [disk_variant_name(file_name, key) for key in item.variants or {}] + [file_name]
+    return list(zip(names, [*(item.variants or {}).values(), item.image_bytes]))
+
+
+def write_disk_batch(jobs: List[Tuple[str, Screenshot]]):
+    """Write a batch of items to the disk tier, runs on the writer thread.
+
+    The data is synced once for the whole batch; the index rows are
+    committed last, in one transaction under a short hold of disk_cache_lock.
+    """
+    if DISK_SEGMENT_MODE:
+        staged, blob_rows = append_segment_batch(jobs)
+    else:
+        staged, blob_rows = write_file_batch(jobs), []
+    if staged:
+        publish_disk_batch(staged, blob_rows)
+
+
+def write_file_batch(jobs: List[Tuple[str, Screenshot]]) -> List[Tuple[str, Screenshot]]:
+    # data goes to dot-prefixed temp files (never served, discarded on startup
+    # after a crash) and is renamed into place once synced
+    staged = []
+    for file_name, item in jobs:
+        moves = [
+            (DISK_CACHE_DIR / f".{name}{DISK_TEMP_SUFFIX}", DISK_CACHE_DIR / name, data)
+            for name, data in disk_family_blobs(file_name, item)
+        ]
+        try:
+            for temp_path, _, data in moves:
+                with open(temp_path, "wb") as temp_file:
+                    temp_file.write(data)
         except OSError as exc:
-            print(f"[disk] failed to store id={item['id']}: {exc}")
-            if data_path.exists():
-                data_path.unlink(missing_ok=True)
-            if meta_path.exists():
-                meta_path.unlink(missing_ok=True)
-            return False
+            log.error("[disk] failed to write id=%s: %s", item.id, exc)
+            for temp_path, _, _ in moves:
+                temp_path.unlink(missing_ok=True)
+            continue
+        staged.append((file_name, item, moves))
+    if not staged:
+        return []
+
+    try:
+        if DISK_WRITE_FSYNC:
+            fsync_paths([temp_path for _, _, moves in staged for temp_path, _, _ in moves])
+        for _, _, moves in staged:
+            for temp_path, final_path, _ in moves:
+                os.replace(temp_path, final_path)
+        if DISK_WRITE_FSYNC:
+            # the renames themselves are durable once the directory is
+            fsync_paths([DISK_CACHE_DIR])
+    except OSError as exc:
+        log.error("[disk] failed to store a batch of %d: %s", len(staged), exc)
+        for file_name, _, moves in staged:
+            for temp_path, _, _ in moves:
+                temp_path.unlink(missing_ok=True)
+            remove_disk_file_family(file_name)
+        return []
+    return [(file_name, item) for file_name, item, _ in staged]
+
+
+def open_active_segment(segment_id: Optional[int] = None):
+    # writer thread only; without an id, reuses the newest segment while it has room
+    global segment_active_id, segment_active_file, segment_active_size
+    close_active_segment()
+    if segment_id is None:
+        segment_ids = list_segment_ids()
+        segment_id = segment_ids[-1] if segment_ids else 1
+        if segment_ids and segment_path(segment_id).stat().st_size >= DISK_SEGMENT_MAX_BYTES:
+            segment_id += 1
+    segment_active_file = open(segment_path(segment_id), "ab")
+    segment_active_id = segment_id
+    segment_active_size = segment_active_file.tell()
+    if DISK_WRITE_FSYNC and segment_active_size == 0:
+        fsync_paths([DISK_SEGMENT_DIR])
+
+
+def close_active_segment():
+    # writer thread only
+    global segment_active_id, segment_active_file, segment_active_size
+    if segment_active_file is None:
+        return
+    try:
+        segment_active_file.flush()
+        if DISK_WRITE_FSYNC:
+            os.fsync(segment_active_file.fileno())
+    finally:
+        segment_active_file.close()
+        segment_active_id, segment_active_file, segment_active_size = None, None, 0
+
+
+def append_to_segment(data: Any) -> Tuple[int, int]:
+    """Append one blob to the active segment; returns (segment, offset)."""
+    global segment_active_size
+    if segment_active_file is None:
+        open_active_segment()
+    elif segment_active_size and segment_active_size + len(data) > DISK_SEGMENT_MAX_BYTES:
+        # sealing syncs the full segment, later batches only sync the new one
+        open_active_segment(segment_active_id + 1)
+    offset = segment_active_size
+    segment_active_file.write(data)
+    segment_active_size += len(data)
+    return segment_active_id, offset
+
+
+def sync_active_segment():
+    if segment_active_file is None:
+        return
+    segment_active_file.flush()
+    if DISK_WRITE_FSYNC:
+        os.fsync(segment_active_file.fileno())
+
+
+def append_segment_batch(jobs: List[Tuple[str, Screenshot]]) -> Tuple[List[Tuple[str, Screenshot]], List[Tuple]]:
+    staged, blob_rows = [], []
+    try:
+        for file_name, item in jobs:
+            stem = file_name.split(".", 1)[0]
+            for name, data in disk_family_blobs(file_name, item):
+                segment_id, offset = append_to_segment(data)
+                blob_rows.append((name, stem, segment_id, offset, len(data)))
+            staged.append((file_name, item))
+        sync_active_segment()
+    except OSError as exc:
+        # nothing is indexed yet, so whatever reached the segment is dead space
+        log.error("[disk] failed to append a batch of %d to segment %s: %s", len(jobs), segment_active_id, exc)
+        try:
+            close_active_segment()
+        except OSError:
+            pass
+        return [], []
+    return staged, blob_rows
 
 
-def load_item_from_disk() -> Optional[Dict[str, Any]]:
+def publish_disk_batch(staged: List[Tuple[str, Screenshot]], blob_rows: List[Tuple]):
+    global disk_cache_count
+    published = []
+    saved_at = time.time()
     with disk_cache_lock:
-        meta_files = sorted(DISK_CACHE_DIR.glob(f"*{DISK_META_SUFFIX}"), key=lambda p: p.stat().st_mtime)
-        for meta_path in meta_files:
-            try:
-                meta = json.loads(meta_path.read_text())
-            except (OSError, json.JSONDecodeError) as exc:
-                print(f"[disk] failed to parse {meta_path.name}: {exc}")
-                meta_path.unlink(missing_ok=True)
-                continue
-            file_name = meta.get("file_name") or f"{meta['id']}{DISK_IMAGE_DEFAULT_SUFFIX}"
-            data_path = DISK_CACHE_DIR / file_name
-            if not data_path.exists():
-                print(f"[disk] missing file for id={meta['id']}, removing meta")
-                meta_path.unlink(missing_ok=True)
-                continue
-            meta_path.unlink(missing_ok=True)
-            register_disk_file_inflight(file_name, meta.get("content_type", "image/png"))
-            print(f"[disk] queued for serving id={meta['id']}, disk_size={disk_cache_count}")
-            return {
-                "id": meta["id"],
-                "page_url": meta["page_url"],
-                "content_type": meta.get("content_type", "image/png"),
-                "disk_file_name": file_name,
-                "original_image_url": meta.get("original_image_url"),
-            }
-    return None
+        try:
+            disk_index_conn.execute("BEGIN")
+            disk_index_conn.executemany(
+                "INSERT OR REPLACE INTO segment_blobs (name, stem, segment, offset, length) VALUES (?, ?, ?, ?, ?)",
+                blob_rows,
+            )
+            for file_name, item in staged:
+                cursor = disk_index_conn.execute(
+                    "INSERT OR IGNORE INTO disk_items "
+                    "(id, file_name, content_type, page_url, original_image_url, saved_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (item.id, file_name, item.content_type, item.page_url, item.original_image_url, saved_at),
+                )
+                if cursor.rowcount == 1:
+                    published.append(
+                        {
+                            "seq": cursor.lastrowid,
+                            "id": item.id,
+                            "file_name": file_name,
+                            "content_type": item.content_type,
+                            "page_url": item.page_url,
+                            "original_image_url": item.original_image_url,
+                        }
+                    )
+            disk_index_conn.execute("COMMIT")
+        except sqlite3.Error as exc:
+            log.error("[disk] failed to index a batch of %d: %s", len(staged), exc)
+            if disk_index_conn.in_transaction:
+                disk_index_conn.execute("ROLLBACK")
+            published = []
+        disk_cache_count += len(published)
+        if not SHARED_MODE:
+            disk_index.extend(published)
+            disk_index_ids.update(entry["id"] for entry in published)
+    published_names = {entry["file_name"] for entry in published}
+    for file_name, _ in staged:
+        if file_name not in published_names:
+            remove_disk_file_family(file_name)
+    log.debug("[disk] stored %d of %d items, disk_size=%d", len(published), len(staged), disk_cache_count)
+
+
+def reclaim_segments():
+    """Drop segments with no live blobs left and compact mostly dead ones.
+
+    Runs on the writer thread, which is the only one appending, so blobs
+    can be moved into the active segment safely. Responses still slicing an
+    unlinked segment keep their mapping until they are sent.
+    """
+    with disk_cache_lock:
+        live_bytes = dict(
+            disk_index_conn.execute("SELECT segment, SUM(length) FROM segment_blobs GROUP BY segment").fetchall()
+        )
+    segment_ids = list_segment_ids()
+    active_id = segment_active_id if segment_active_id is not None else max(segment_ids, default=None)
+    dropped = compacted = 0
+    for segment_id in segment_ids:
+        if segment_id == active_id:
+            continue
+        live = live_bytes.get(segment_id, 0)
+        if live and live >= segment_path(segment_id).stat().st_size * DISK_SEGMENT_COMPACT_RATIO:
+            continue
+        if live:
+            compact_segment(segment_id)
+            compacted += 1
+        segment_path(segment_id).unlink(missing_ok=True)
+        drop_segment_map(segment_id)
+        dropped += 1
+    if dropped:
+        log.info("[disk] reclaimed %d segments, %d of them compacted", dropped, compacted)
 
 
-def should_idle_fetchers() -> bool:
-    return cache_len() >= CACHE_MAX_SIZE and get_disk_cache_count() >= DISK_CACHE_MAX_ITEMS
+def compact_segment(segment_id: int):
+    with disk_cache_lock:
+        rows = disk_index_conn.execute(
+            "SELECT name, offset, length FROM segment_blobs WHERE segment = ?", (segment_id,)
+        ).fetchall()
+    moved = []
+    with open(segment_path(segment_id), "rb") as segment_file:
+        for name, offset, length in rows:
+            new_segment, new_offset = append_to_segment(os.pread(segment_file.fileno(), length, offset))
+            moved.append((new_segment, new_offset, name, segment_id))
+    sync_active_segment()
+    with disk_cache_lock:
+        disk_index_conn.execute("BEGIN")
+        try:
+            # blobs removed meanwhile no longer match and stay dead space
+            disk_index_conn.executemany(
+                "UPDATE segment_blobs SET segment = ?, offset = ? WHERE name = ? AND segment = ?", moved
+            )
+            disk_index_conn.execute("COMMIT")
+        except sqlite3.Error:
+            disk_index_conn.execute("ROLLBACK")
+            raise
+
+
+def pop_disk_index_entries(limit: int) -> List[Dict[str, Any]]:
+    # caller holds disk_cache_lock
+    if SHARED_MODE:
+        # a single DELETE ... RETURNING statement, so two workers can never
+        # pop the same row
+        rows = disk_index_conn.execute(
+            "DELETE FROM disk_items WHERE seq IN (SELECT seq FROM disk_items ORDER BY seq LIMIT ?) "
+            f"RETURNING {DISK_INDEX_COLUMNS}",
+            (limit,),
+        ).fetchall()
+        return sorted((disk_entry_from_row(row) for row in rows), key=lambda entry: entry["seq"])
+    entries = []
+    while disk_index and len(entries) < limit:
+        entry = disk_index.popleft()
+        disk_index_ids.discard(entry["id"])
+        entries.append(entry)
+    if entries:
+        disk_index_conn.executemany("DELETE FROM disk_items WHERE seq = ?", [(entry["seq"],) for entry in entries])
+    return entries
+
+
+def pop_disk_index_entry() -> Optional[Dict[str, Any]]:
+    # caller holds disk_cache_lock
+    entries = pop_disk_index_entries(1)
+    return entries[0] if entries else None
+
+
+def load_items_from_disk(limit: int) -> List[Screenshot]:
+    """Pop up to limit servable items, oldest first, under one lock acquisition."""
+    global disk_cache_count
+    items = []
+    with disk_cache_lock:
+        while len(items) < limit:
+            try:
+                entries = pop_disk_index_entries(limit - len(items))
+            except sqlite3.Error as exc:
+                log.error("[disk] failed to pop from index: %s", exc)
+                break
+            if not entries:
+                break
+            disk_cache_count = max(0, disk_cache_count - len(entries))
+            for entry in entries:
+                file_name = entry["file_name"]
+                if DISK_SEGMENT_MODE:
+                    present = locate_segment_blob(file_name) is not None
+                else:
+                    present = (DISK_CACHE_DIR / file_name).exists()
+                if not present:
+                    log.warning("[disk] missing file for id=%s, dropping entry", entry["id"])
+                    continue
+                try:
+                    lease_disk_file(file_name, entry["content_type"])
+                except sqlite3.Error as exc:
+                    log.error("[disk] failed to lease %s: %s", file_name, exc)
+                log.debug("[disk] queued for serving id=%s, disk_size=%d", entry["id"], disk_cache_count)
+                items.append(
+                    Screenshot(
+                        entry["id"],
+                        entry["page_url"],
+                        original_image_url=entry["original_image_url"],
+                        content_type=entry["content_type"],
+                        disk_file_name=file_name,
+                    )
+                )
+    return items
+
+
+def load_item_from_disk() -> Optional[Screenshot]:
+    items = load_items_from_disk(1)
+    return items[0] if items else None
+
+
+def open_broker() -> sqlite3.Connection:
+    conn = sqlite3.connect(str(BROKER_DB_PATH), isolation_level=None, check_same_thread=False)
+    conn.execute(f"PRAGMA busy_timeout={BROKER_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS egress_state (
+            route TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            rate REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            ban_strikes INTEGER NOT NULL,
+            last_ban_at REAL NOT NULL,
+            ban_active INTEGER NOT NULL,
+            next_retry_at REAL NOT NULL,
+            reason TEXT NOT NULL
+        )
+        """
+    )
+    # rows from before EgressRoute.state_key were keyed by the raw spec,
+    # proxy credentials included
+    conn.execute("DELETE FROM egress_state WHERE route LIKE '%:%'")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ban_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            active INTEGER NOT NULL,
+            next_retry_at REAL NOT NULL,
+            reason TEXT NOT NULL
+        )
+        """
+    )
+    return conn
+
+
+def init_broker():
+    global broker_conn
+    BROKER_DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with broker_lock:
+        if broker_conn is None:
+            broker_conn = open_broker()
+
+
+def base_prnt_rate() -> float:
+    return PRNT_RATE_LIMIT / PRNT_RATE_WINDOW
+
+
+def egress_budget_rate() -> float:
+    """Page requests per second the unbanned routes can take together."""
+    if not egress_routes:
+        return base_prnt_rate()
+    return sum(route.rate for route in egress_routes if not route.ban_active)
+
+
+def broker_load_egress_state():
+    """Resume every route's bucket, rate and ban state from the broker.
+
+    The fetcher owns the buckets in memory and persists them every
+    EGRESS_STATE_PERSIST_INTERVAL, so a new fetcher resumes with what was
+    left plus the refill since, instead of a full burst.
+    """
+    with broker_lock:
+        rows = broker_conn.execute(
+            "SELECT route, tokens, rate, updated_at, ban_strikes, last_ban_at, ban_active, next_retry_at, reason "
+            "FROM egress_state"
+        ).fetchall()
+    saved = {row[0]: row[1:] for row in rows}
+    base = base_prnt_rate()
+    for route in egress_routes:
+        if route.state_key not in saved:
+            continue
+        tokens, rate, updated_at, strikes, last_ban_at, ban_active, next_retry_at, reason = saved[route.state_key]
+        route.tokens, route.tokens_at = tokens, updated_at
+        route.rate = clamp(rate, base * PRNT_RATE_MIN_FACTOR, base * PRNT_RATE_MAX_FACTOR)
+        route.ban_strikes, route.last_ban_at = strikes, last_ban_at
+        route.ban_active, route.next_retry_ts, route.ban_reason = bool(ban_active), next_retry_at, reason
+    for route in egress_routes:
+        PRNT_RATE.labels(route.name).set(route.rate)
+        EGRESS_BANNED.labels(route.name).set(int(route.ban_active))
+    refresh_prnt_ban_state()
+
+
+def broker_store_egress_state():
+    rows = [
+        (
+            route.state_key,
+            route.tokens,
+            route.rate,
+            route.tokens_at,
+            route.ban_strikes,
+            route.last_ban_at,
+            int(route.ban_active),
+            route.next_retry_ts,
+            route.ban_reason,
+        )
+        for route in egress_routes
+    ]
+    with broker_lock:
+        broker_conn.execute("BEGIN IMMEDIATE")
+        try:
+            broker_conn.executemany("INSERT OR REPLACE INTO egress_state VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            # consumers only look at the aggregate
+            broker_conn.execute(
+                "INSERT OR REPLACE INTO ban_state (id, active, next_retry_at, reason) VALUES (1, ?, ?, ?)",
+                (int(prnt_ban_active), prnt_next_retry_ts, prnt_ban_reason),
+            )
+            broker_conn.execute("COMMIT")
+        except sqlite3.Error:
+            broker_conn.execute("ROLLBACK")
+            raise
+
+
+async def egress_state_persist_loop():
+    while True:
+        try:
+            await asyncio.wait_for(egress_state_dirty.wait(), EGRESS_STATE_PERSIST_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        egress_state_dirty.clear()
+        try:
+            await asyncio.to_thread(broker_store_egress_state)
+        except sqlite3.Error as exc:
+            log.error("[egress] failed to save route state: %s", exc)
 
 
-def enforce_prnt_rate_limit():
-    while True:
-        with prnt_rate_lock:
-            now = time.monotonic()
-            while prnt_request_times and now - prnt_request_times[0] >= PRNT_RATE_WINDOW:
-                prnt_request_times.popleft()
-            if len(prnt_request_times) < PRNT_RATE_LIMIT:
-                prnt_request_times.append(now)
-                return
-            wait_for = PRNT_RATE_WINDOW - (now - prnt_request_times[0])
-        sleep_for = max(PRNT_RATE_SLEEP_SLICE, wait_for)
-        time.sleep(min(sleep_for, PRNT_RATE_WINDOW))
+def broker_load_ban_state():
+    global prnt_ban_active, prnt_next_retry_ts, prnt_ban_reason, prnt_ban_checked_at
+    with broker_lock:
+        row = broker_conn.execute("SELECT active, next_retry_at, reason FROM ban_state WHERE id = 1").fetchone()
+    prnt_ban_checked_at = time.monotonic()
+    if row:
+        prnt_ban_active, prnt_next_retry_ts, prnt_ban_reason = bool(row[0]), row[1], row[2]
 
 
-def attempt_prnt_probe() -> bool:
-    print("[ban] attempting probe request to prnt.sc")
+def try_become_fetcher() -> bool:
+    """Grab the cross-process fetcher lock; the kernel drops it if we die."""
+    global fetcher_lock_file, is_fetcher_process
+    if is_fetcher_process:
+        return True
+    FETCHER_LOCK_PATH.parent.mkdir(parents=True, exist_ok=True)
+    lock_file = open(FETCHER_LOCK_PATH, "a+")
     try:
-        enforce_prnt_rate_limit()
-        resp = SESSION.get(PRNT_BASE_URL, headers=COMMON_HEADERS, timeout=5)
-        if resp.status_code == 200:
-            print("[ban] probe successful")
-            return True
-        print(f"[ban] probe failed with status {resp.status_code}")
-    except requests.exceptions.RequestException as exc:
-        print(f"[ban] probe exception: {exc}")
-    return False
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write(str(os.getpid()))
+    lock_file.flush()
+    fetcher_lock_file = lock_file
+    is_fetcher_process = True
+    return True
+
+
+def release_fetcher_role():
+    global fetcher_lock_file, is_fetcher_process
+    if fetcher_lock_file is not None:
+        fcntl.flock(fetcher_lock_file.fileno(), fcntl.LOCK_UN)
+        fetcher_lock_file.close()
+        fetcher_lock_file = None
+    is_fetcher_process = False
+
+
+def describe_egress_route(spec: str) -> str:
+    if "://" not in spec:
+        return spec
+    parsed = urlparse(spec)
+    return f"{parsed.scheme}://{parsed.hostname}" + (f":{parsed.port}" if parsed.port else "")
+
+
+def build_egress_client(spec: str) -> httpx.AsyncClient:
+    limits = httpx.Limits(max_connections=EGRESS_MAX_CONNECTIONS, max_keepalive_connections=EGRESS_MAX_CONNECTIONS)
+    if spec == "direct":
+        return httpx.AsyncClient(follow_redirects=True, limits=limits)
+    if spec.startswith("source:"):
+        transport = httpx.AsyncHTTPTransport(local_address=spec.removeprefix("source:"), limits=limits)
+        return httpx.AsyncClient(follow_redirects=True, transport=transport)
+    return httpx.AsyncClient(follow_redirects=True, limits=limits, proxy=spec)
+
+
+def init_egress_routes():
+    if egress_routes:
+        return
+    for spec in dict.fromkeys(PRNT_EGRESS_ROUTES):
+        egress_routes.append(EgressRoute(spec, build_egress_client(spec)))
+    log.info("[egress] %d routes: %s", len(egress_routes), ", ".join(route.name for route in egress_routes))
+
+
+async def close_egress_routes():
+    for route in egress_routes:
+        await route.client.aclose()
+
+
+def egress_token_wait(route: EgressRoute, now: float) -> float:
+    """Refill the route's bucket up to now; seconds until it holds a token."""
+    route.tokens = min(PRNT_RATE_BURST, route.tokens + max(0.0, now - route.tokens_at) * route.rate)
+    route.tokens_at = now
+    return 0.0 if route.tokens >= 1 else (1 - route.tokens) / route.rate
+
+
+async def acquire_egress_route() -> EgressRoute:
+    """Take a token from the unbanned route that can send soonest.
+
+    Ties go to the route with fewer ban strikes, then fewer requests in
+    flight. While every route is banned the caller waits for the probe loop
+    to clear one.
+    """
+    started = time.monotonic()
+    async with egress_lock:
+        while True:
+            now = time.time()
+            candidates = [(egress_token_wait(route, now), route) for route in egress_routes if not route.ban_active]
+            timeout = None
+            if candidates:
+                wait_for, route = min(candidates, key=lambda pair: (pair[0], pair[1].ban_strikes, pair[1].in_flight))
+                if wait_for <= 0:
+                    route.tokens -= 1
+                    RATE_LIMIT_WAIT_SECONDS.observe(time.monotonic() - started)
+                    return route
+                timeout = wait_for
+            egress_changed.clear()
+            try:
+                await asyncio.wait_for(egress_changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+def adjust_egress_rate(route: EgressRoute, ok: bool):
+    """AIMD: creep up by PRNT_RATE_INCREASE per good page, cut on ban signals."""
+    base = base_prnt_rate()
+    rate = route.rate + PRNT_RATE_INCREASE if ok else route.rate * PRNT_RATE_DECREASE
+    route.rate = clamp(rate, base * PRNT_RATE_MIN_FACTOR, base * PRNT_RATE_MAX_FACTOR)
+    PRNT_RATE.labels(route.name).set(route.rate)
+
+
+def next_ban_retry_delay(route: EgressRoute) -> float:
+    now = time.time()
+    if now - route.last_ban_at > BAN_STRIKE_RESET_SECONDS:
+        route.ban_strikes = 0
+    route.ban_strikes += 1
+    route.last_ban_at = now
+    delay = min(BAN_BACKOFF_MAX_SECONDS, BAN_BACKOFF_BASE_SECONDS * 2 ** (route.ban_strikes - 1))
+    return delay * random.uniform(1 - BAN_BACKOFF_JITTER, 1 + BAN_BACKOFF_JITTER)
 
 
-def mark_prnt_banned(reason: str):
+def refresh_prnt_ban_state():
     global prnt_ban_active, prnt_next_retry_ts, prnt_ban_reason
-    with prnt_ban_lock:
-        prnt_ban_active = True
-        prnt_next_retry_ts = time.monotonic() + BAN_INTERVAL_SECONDS
-        prnt_ban_reason = reason
-        print(f"[ban] marked prnt.sc as banned: {reason}")
+    banned = [route for route in egress_routes if route.ban_active]
+    prnt_ban_active = bool(banned) and len(banned) == len(egress_routes)
+    prnt_next_retry_ts = min(route.next_retry_ts for route in banned) if prnt_ban_active else 0.0
+    prnt_ban_reason = "; ".join(f"{route.name}: {route.ban_reason}" for route in banned) if prnt_ban_active else ""
+
+
+def mark_egress_banned(route: EgressRoute, reason: str):
+    adjust_egress_rate(route, False)
+    if route.ban_active:
+        return
+    route.ban_active = True
+    retry_in = next_ban_retry_delay(route)
+    route.next_retry_ts = time.time() + retry_in
+    route.ban_reason = reason
+    refresh_prnt_ban_state()
+    egress_state_dirty.set()
+    BAN_TRANSITIONS.labels(route.name, "banned").inc()
+    EGRESS_BANNED.labels(route.name).set(1)
+    log.warning(
+        "[ban] route %s banned: %s, strike %d, retry in %.0fs", route.name, reason, route.ban_strikes, retry_in
+    )
+
+
+async def probe_egress_route(route: EgressRoute):
+    log.info("[ban] probing route %s", route.name)
+    # a probe spends a token of the route it tests, like any page request
+    wait_for = egress_token_wait(route, time.time())
+    if wait_for > 0:
+        await asyncio.sleep(wait_for)
+        egress_token_wait(route, time.time())
+    route.tokens -= 1
+    try:
+        resp = await route.client.get(PRNT_BASE_URL, headers=COMMON_HEADERS, timeout=HTTP_TIMEOUT)
+        ok = resp.status_code == 200
+        if not ok:
+            log.warning("[ban] probe of %s failed with status %d", route.name, resp.status_code)
+    except httpx.HTTPError as exc:
+        ok = False
+        log.warning("[ban] probe of %s failed: %s", route.name, exc)
+    adjust_egress_rate(route, ok)
+    if ok:
+        route.ban_active = False
+        route.ban_reason = ""
+        route.next_retry_ts = 0.0
+        BAN_TRANSITIONS.labels(route.name, "unbanned").inc()
+        EGRESS_BANNED.labels(route.name).set(0)
+        log.warning("[ban] route %s unbanned", route.name)
+        egress_changed.set()
+    else:
+        retry_in = next_ban_retry_delay(route)
+        route.next_retry_ts = time.time() + retry_in
+        log.warning(
+            "[ban] route %s still banned, strike %d, next probe in %.0fs", route.name, route.ban_strikes, retry_in
+        )
+    refresh_prnt_ban_state()
+    egress_state_dirty.set()
 
 
-def wait_for_prnt_availability():
-    global prnt_ban_active, prnt_ban_reason, prnt_next_retry_ts
+async def egress_probe_loop():
+    # each banned route is probed on its own backoff schedule
     while True:
-        with prnt_ban_lock:
-            if not prnt_ban_active:
-                return
-            retry_at = prnt_next_retry_ts
-        now = time.monotonic()
-        if now < retry_at:
-            time.sleep(min(retry_at - now, 5))
-            continue
-        if attempt_prnt_probe():
-            with prnt_ban_lock:
-                prnt_ban_active = False
-                prnt_ban_reason = ""
-                prnt_next_retry_ts = 0.0
-            return
-        with prnt_ban_lock:
-            prnt_next_retry_ts = time.monotonic() + BAN_INTERVAL_SECONDS
-        time.sleep(min(BAN_INTERVAL_SECONDS, 10))
+        now = time.time()
+        due = [route for route in egress_routes if route.ban_active and route.next_retry_ts <= now]
+        if due:
+            await asyncio.gather(*(probe_egress_route(route) for route in due), return_exceptions=True)
+        retries = [route.next_retry_ts for route in egress_routes if route.ban_active]
+        delay = min(retries) - time.time() if retries else EGRESS_PROBE_CHECK_INTERVAL
+        await asyncio.sleep(clamp(delay, 0.0, EGRESS_PROBE_CHECK_INTERVAL))
 
 
 def is_prnt_banned() -> bool:
-    with prnt_ban_lock:
-        return prnt_ban_active
+    # the fetcher owns the ban state, other workers read it from the broker
+    if not is_fetcher_process and time.monotonic() - prnt_ban_checked_at >= BAN_STATE_REFRESH_SECONDS:
+        broker_load_ban_state()
+    return prnt_ban_active
 
 
 def get_prnt_ban_message() -> Optional[str]:
@@ -400,46 +1863,259 @@ def get_prnt_ban_message() -> Optional[str]:
     return None
 
 
-def build_data_url(item: Dict[str, Any]) -> str:
-    b64 = base64.b64encode(item["image_bytes"]).decode("ascii")
-    content_type = item.get("content_type", "image/png")
-    return f"data:{content_type};base64,{b64}"
+def prune_image_handoffs(now: float):
+    # caller holds image_handoff_lock
+    global image_handoff_bytes
+    while image_handoff_table:
+        entry = next(iter(image_handoff_table.values()))
+        if entry["expires_at"] > now and image_handoff_bytes <= IMAGE_HANDOFF_MAX_BYTES:
+            break
+        image_handoff_table.popitem(last=False)
+        image_handoff_bytes -= entry["item"].size
+        log.debug("[img] handoff expired id=%s", entry["item"].id)
+
+
+def register_image_handoff(item: Screenshot) -> str:
+    global image_handoff_bytes
+    token = secrets.token_urlsafe(9)
+    now = time.monotonic()
+    with image_handoff_lock:
+        image_handoff_table[token] = {
+            "item": item,
+            "expires_at": now + IMAGE_HANDOFF_TTL_SECONDS,
+        }
+        image_handoff_bytes += item.size
+        prune_image_handoffs(now)
+    return token
+
 
+def claim_image_handoff(token: str) -> Optional[Screenshot]:
+    with image_handoff_lock:
+        prune_image_handoffs(time.monotonic())
+        entry = image_handoff_table.get(token)
+    return entry["item"] if entry else None
 
-def prepare_payload(item: Dict[str, Any]) -> Dict[str, Any]:
+
+def prepare_payload(item: Screenshot) -> Dict[str, Any]:
     payload = {
-        "id": item["id"],
-        "page_url": item["page_url"],
-        "original_image_url": item.get("original_image_url"),
+        "id": item.id,
+        "page_url": item.page_url,
+        "original_image_url": item.original_image_url,
     }
-    if item.get("disk_file_name"):
-        payload["image_url"] = f"/storage/{item['disk_file_name']}"
+    if item.disk_file_name:
+        payload["image_url"] = f"/storage/{item.disk_file_name}"
         payload["image_source"] = "disk"
-    elif item.get("image_bytes"):
-        payload["image_url"] = build_data_url(item)
+    elif item.image_bytes and not SHARED_MODE:
+        # handoff tokens live in this process only, other workers would 404
+        payload["image_url"] = f"/img/{register_image_handoff(item)}"
         payload["image_source"] = "memory"
     else:
-        payload["image_url"] = item.get("image_url") or item.get("original_image_url")
+        payload["image_url"] = item.original_image_url
         payload["image_source"] = "external"
+    local = payload["image_source"] != "external"
+    payload["preview_url"] = f"{payload['image_url']}?w={PREVIEW_WIDTH}" if local else payload["image_url"]
     return payload
 
 
                                                                       
 
+def init_negative_cache():
+    """Map the negative cache file; pages are faulted in lazily, so boot stays fast."""
+    global negative_cache_file, negative_cache_map, negative_cache_cells
+    size = NEGATIVE_CACHE_CELLS * 2
+    NEGATIVE_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    cache_file = open(NEGATIVE_CACHE_PATH, "a+b")
+    if os.fstat(cache_file.fileno()).st_size != size:
+        # a resized filter cannot be reinterpreted, start from scratch
+        cache_file.truncate(0)
+        cache_file.truncate(size)
+    negative_cache_map = mmap.mmap(cache_file.fileno(), size)
+    negative_cache_cells = memoryview(negative_cache_map).cast("H")
+    negative_cache_file = cache_file
+    log.info("[neg] mapped %d cells from %s", NEGATIVE_CACHE_CELLS, NEGATIVE_CACHE_PATH)
+
+
+def flush_negative_cache():
+    if negative_cache_map is not None:
+        negative_cache_map.flush()
+
+
+def negative_cache_hour(ts: float) -> int:
+    return int((ts - NEGATIVE_CACHE_EPOCH) // 3600)
+
+
+def negative_cache_slots(prnt_id: str) -> List[int]:
+    digest = hashlib.blake2b(prnt_id.encode(), digest_size=4 * NEGATIVE_CACHE_HASHES).digest()
+    return [
+        int.from_bytes(digest[i : i + 4], "little") % NEGATIVE_CACHE_CELLS
+        for i in range(0, len(digest), 4)
+    ]
+
+
+def remember_negative_id(prnt_id: str, reason: str):
+    ttl = NEGATIVE_CACHE_TTLS.get(reason)
+    if ttl is None or negative_cache_cells is None:
+        return
+    expires = min(negative_cache_hour(time.time() + ttl) + 1, 0xFFFF)
+    cells = negative_cache_cells
+    for slot in negative_cache_slots(prnt_id):
+        if cells[slot] < expires:
+            cells[slot] = expires
+
+
+def is_known_negative_id(prnt_id: str) -> bool:
+    """True if every slot for the ID holds an unexpired entry (may be a false positive)."""
+    if negative_cache_cells is None:
+        return False
+    now = negative_cache_hour(time.time())
+    cells = negative_cache_cells
+    return all(cells[slot] > now for slot in negative_cache_slots(prnt_id))
+
+
+def load_id_sampler_stats():
+    global id_sampler_stats
+    try:
+        raw = json.loads(ID_SAMPLER_STATS_PATH.read_text())
+    except FileNotFoundError:
+        return
+    except (OSError, json.JSONDecodeError) as exc:
+        log.warning("[ids] ignoring unreadable stats file: %s", exc)
+        return
+    with id_sampler_lock:
+        id_sampler_stats = {
+            prefix: [int(counts[0]), int(counts[1])]
+            for prefix, counts in raw.get("prefixes", {}).items()
+            if len(prefix) == ID_SAMPLER_PREFIX_LEN
+        }
+    log.info("[ids] loaded outcome stats for %d prefixes", len(id_sampler_stats))
+
+
+def save_id_sampler_stats():
+    global id_sampler_dirty
+    with id_sampler_lock:
+        if not id_sampler_dirty:
+            return
+        payload = json.dumps({"prefix_len": ID_SAMPLER_PREFIX_LEN, "prefixes": id_sampler_stats})
+        id_sampler_dirty = False
+    tmp_path = ID_SAMPLER_STATS_PATH.with_suffix(".tmp")
+    tmp_path.write_text(payload)
+    os.replace(tmp_path, ID_SAMPLER_STATS_PATH)
+
+
+async def id_sampler_persist_loop():
+    while True:
+        await asyncio.sleep(ID_SAMPLER_SAVE_INTERVAL)
+        try:
+            await asyncio.to_thread(save_id_sampler_stats)
+            await asyncio.to_thread(flush_negative_cache)
+        except OSError as exc:
+            log.error("[ids] failed to save stats: %s", exc)
+
+
+def record_id_outcome(prnt_id: str, reason: str):
+    """Feed a candidate outcome ("valid" or a rejection reason) to the sampler."""
+    global id_sampler_dirty
+    if reason in ID_SAMPLER_TRANSIENT_REASONS:
+        return
+    prefix = prnt_id[:ID_SAMPLER_PREFIX_LEN]
+    with id_sampler_lock:
+        counts = id_sampler_stats.setdefault(prefix, [0, 0])
+        counts[0 if reason == "valid" else 1] += 1
+        id_sampler_dirty = True
+
+
+def random_id_chars(length: int) -> str:
+    return "".join(random.choice(ID_ALPHABET) for _ in range(length))
+
+
+def choose_id_prefix() -> str:
+    """Thompson sampling over ID prefixes with per-prefix Beta posteriors."""
+    if random.random() < ID_SAMPLER_EXPLORATION:
+        return random_id_chars(ID_SAMPLER_PREFIX_LEN)
+    prior_valid, prior_invalid = ID_SAMPLER_PRIOR
+    with id_sampler_lock:
+        observed = [(prefix, counts[0], counts[1]) for prefix, counts in id_sampler_stats.items()]
+    best_prefix = None
+    best_score = -1.0
+    # all unseen prefixes share the prior, one draw stands in for them;
+    # ID_SAMPLER_EXPLORATION makes up for the optimism this gives away
+    if len(observed) < len(ID_ALPHABET) ** ID_SAMPLER_PREFIX_LEN:
+        best_score = random.betavariate(prior_valid, prior_invalid)
+    for prefix, valid, invalid in observed:
+        score = random.betavariate(prior_valid + valid, prior_invalid + invalid)
+        if score > best_score:
+            best_prefix, best_score = prefix, score
+    if best_prefix is not None:
+        return best_prefix
+    while True:
+        prefix = random_id_chars(ID_SAMPLER_PREFIX_LEN)
+        if prefix not in id_sampler_stats:
+            return prefix
+
+
 def generate_id(length: int = 6) -> str:
-    chars = string.ascii_lowercase + string.digits
-    return "".join(random.choice(chars) for _ in range(length))
+    for _ in range(NEGATIVE_CACHE_MAX_REDRAWS):
+        prefix = choose_id_prefix()[:length]
+        prnt_id = prefix + random_id_chars(length - len(prefix))
+        if not is_known_negative_id(prnt_id):
+            return prnt_id
+        NEGATIVE_CACHE_SKIPS.inc()
+    return prnt_id
+
+
+_HEAD_END_RE = re.compile(rb"</head\s*>", re.IGNORECASE)
+_OG_IMAGE_TAG_RE = re.compile(rb"<meta\s[^>]*?property\s*=\s*[\"']og:image[\"'][^>]*>", re.IGNORECASE)
+_SCREENSHOT_IMG_TAG_RE = re.compile(rb"<img\s[^>]*?id\s*=\s*[\"']screenshot-image[\"'][^>]*>", re.IGNORECASE)
+_CONTENT_ATTR_RE = re.compile(rb"\scontent\s*=\s*(?:\"([^\"]*)\"|'([^']*)')", re.IGNORECASE)
+_SRC_ATTR_RE = re.compile(rb"\ssrc\s*=\s*(?:\"([^\"]*)\"|'([^']*)')", re.IGNORECASE)
+_BAN_KEYWORDS_RE = re.compile(
+    b"|".join(re.escape(keyword.encode()) for keyword in BAN_KEYWORDS),
+    re.IGNORECASE,
+)
+
+
+def _attr_from_tag(tag_re: "re.Pattern[bytes]", attr_re: "re.Pattern[bytes]", html: bytes) -> Optional[str]:
+    tag = tag_re.search(html)
+    if not tag:
+        return None
+    attr = attr_re.search(tag.group(0))
+    if not attr:
+        return None
+    value = attr.group(1) if attr.group(1) is not None else attr.group(2)
+    value = unescape(value.decode("utf-8", "replace")).strip()
+    return value or None
 
 
-def _extract_image_url_from_html(html: str) -> Optional[str]:
+def extract_image_url_fast(html: bytes) -> Optional[str]:
+    """Regex scanner for the two tags we care about, no DOM is built."""
+    return _attr_from_tag(_OG_IMAGE_TAG_RE, _CONTENT_ATTR_RE, html) or _attr_from_tag(
+        _SCREENSHOT_IMG_TAG_RE, _SRC_ATTR_RE, html
+    )
+
+
+def extract_image_url_lxml(html: bytes) -> Optional[str]:
+    if lxml_html is None:
+        return None
+    try:
+        root = lxml_html.fromstring(html)
+    except (ValueError, lxml_etree.ParserError):
+        return None
+    for xpath in ('//meta[@property="og:image"]/@content', '//img[@id="screenshot-image"]/@src'):
+        values = root.xpath(xpath)
+        if values and values[0]:
+            return str(values[0])
+    return None
+
+
+def extract_image_url_bs4(html: bytes) -> Optional[str]:
     soup = BeautifulSoup(html, "html.parser")
 
-                                 
+    # 1) og:image in meta tags
     meta = soup.find("meta", property="og:image")
     if meta and meta.get("content"):
         return meta["content"]
 
-                                                
+    # 2) fallback: <img id="screenshot-image">
     img = soup.find("img", id="screenshot-image")
     if img and img.get("src"):
         return img.get("src")
@@ -447,6 +2123,96 @@ def _extract_image_url_from_html(html: str) -> Optional[str]:
     return None
 
 
+HTML_EXTRACTORS: Dict[str, Callable[[bytes], Optional[str]]] = {
+    "fast": extract_image_url_fast,
+    "lxml": extract_image_url_lxml,
+    "bs4": extract_image_url_bs4,
+}
+
+
+def extract_image_url_from_html(html: bytes) -> Optional[str]:
+    for name in HTML_EXTRACTOR_ORDER:
+        img_url = HTML_EXTRACTORS[name](html)
+        if img_url:
+            return img_url
+    return None
+
+
+def contains_ban_keyword(html: bytes) -> bool:
+    return _BAN_KEYWORDS_RE.search(html) is not None
+
+
+async def read_page_head(chunks: AsyncIterator[bytes]) -> bytes:
+    head = bytearray()
+    async for chunk in chunks:
+        head.extend(chunk)
+        # only rescan the tail that could contain a fresh "</head>"
+        if _HEAD_END_RE.search(head, max(0, len(head) - len(chunk) - 16)):
+            break
+        if len(head) >= PAGE_HEAD_MAX_BYTES:
+            break
+    return bytes(head)
+
+
+async def fetch_prnt_page(prnt_id: str, page_url: str) -> Optional[str]:
+    """Fetch a prnt.sc page and return the raw screenshot URL from it.
+
+    Only the <head> is scanned on the fast path; the rest of the body is
+    drained (so the connection can be reused) and parsed only when the
+    head did not contain the image URL.
+    """
+    route = await acquire_egress_route()
+    route.in_flight += 1
+    page_started = time.monotonic()
+    try:
+        async with route.client.stream("GET", page_url, headers=COMMON_HEADERS, timeout=HTTP_TIMEOUT) as resp:
+            if resp.status_code in BAN_STATUS_CODES:
+                mark_egress_banned(route, f"status {resp.status_code}")
+                reject_candidate(prnt_id, "banned")
+                return None
+
+            if resp.status_code != 200:
+                log.debug("[page] non-200 (%d) for id=%s", resp.status_code, prnt_id)
+                reject_candidate(prnt_id, "page_non_200")
+                return None
+
+            chunks = resp.aiter_bytes()
+            html = await read_page_head(chunks)
+            if contains_ban_keyword(html):
+                mark_egress_banned(route, "keyword match in html")
+                reject_candidate(prnt_id, "banned")
+                return None
+            adjust_egress_rate(route, True)
+
+            img_url = extract_image_url_fast(html)
+            if img_url:
+                async for _ in chunks:
+                    pass
+                return img_url
+
+            rest = bytearray(html)
+            async for chunk in chunks:
+                rest.extend(chunk)
+            html = bytes(rest)
+    except httpx.HTTPError as e:
+        log.debug("[page] error for id=%s: %s", prnt_id, e)
+        reject_candidate(prnt_id, "page_error")
+        return None
+    finally:
+        route.in_flight -= 1
+        record_page_latency(time.monotonic() - page_started)
+
+    if contains_ban_keyword(html):
+        mark_egress_banned(route, "keyword match in html")
+        reject_candidate(prnt_id, "banned")
+        return None
+    img_url = extract_image_url_from_html(html)
+    if not img_url:
+        log.debug("[parse] no img tag for id=%s", prnt_id)
+        reject_candidate(prnt_id, "no_img_tag")
+    return img_url
+
+
 def is_blocked_domain(url: str) -> bool:
     try:
         parsed = urlparse(url)
@@ -460,33 +2226,13 @@ def is_blocked_domain(url: str) -> bool:
     return False
 
 
-def fetch_prnt_image(prnt_id: str) -> Optional[Dict[str, Any]]:
+async def resolve_candidate(prnt_id: str) -> Optional[Screenshot]:
+    """Stage 1: turn a prnt.sc ID into a screenshot URL (spends prnt.sc budget)."""
     page_url = f"{PRNT_BASE_URL}/{prnt_id}"
 
-    wait_for_prnt_availability()
-    try:
-        enforce_prnt_rate_limit()
-        resp = SESSION.get(page_url, headers=COMMON_HEADERS, timeout=5)
-    except requests.exceptions.RequestException as e:
-        print(f"[page] error for id={prnt_id}: {e}")
-        return None
-
-    if resp.status_code in BAN_STATUS_CODES:
-        mark_prnt_banned(f"status {resp.status_code}")
-        return None
-
-    if resp.status_code != 200:
-        print(f"[page] non-200 ({resp.status_code}) for id={prnt_id}")
-        return None
-
-    lowered_html = resp.text.lower()
-    if any(keyword in lowered_html for keyword in BAN_KEYWORDS):
-        mark_prnt_banned("keyword match in html")
-        return None
-
-    img_url = _extract_image_url_from_html(resp.text)
+    CANDIDATES_TOTAL.inc()
+    img_url = await fetch_prnt_page(prnt_id, page_url)
     if not img_url:
-        print(f"[parse] no img tag for id={prnt_id}")
         return None
 
     if img_url.startswith("//"):
@@ -495,76 +2241,340 @@ def fetch_prnt_image(prnt_id: str) -> Optional[Dict[str, Any]]:
         img_url = PRNT_BASE_URL + img_url
 
     if not img_url.startswith("http"):
-        print(f"[parse] bad img url for id={prnt_id}: {img_url}")
+        log.debug("[parse] bad img url for id=%s: %s", prnt_id, img_url)
+        reject_candidate(prnt_id, "bad_img_url")
         return None
 
     if is_blocked_domain(img_url):
-        print(f"[filter] blocked domain for id={prnt_id}: {img_url}")
+        log.debug("[filter] blocked domain for id=%s: %s", prnt_id, img_url)
+        reject_candidate(prnt_id, "blocked_domain")
         return None
 
     bad_parts = ["image-not-found", "st.prntscr.com"]
     if any(bad in img_url for bad in bad_parts):
-        print(f"[filter] bad pattern in url for id={prnt_id}: {img_url}")
+        log.debug("[filter] bad pattern in url for id=%s: %s", prnt_id, img_url)
+        reject_candidate(prnt_id, "bad_pattern")
         return None
 
+    return Screenshot(prnt_id, page_url, original_image_url=img_url)
+
+
+def get_image_host_gate(host: str) -> Dict[str, Any]:
+    gate = image_host_gates.get(host)
+    if gate is None:
+        gate = {
+            "semaphore": asyncio.Semaphore(IMAGE_HOST_CONCURRENCY),
+            "lock": asyncio.Lock(),
+            "times": deque(),
+        }
+        image_host_gates[host] = gate
+    return gate
+
+
+async def acquire_image_host_budget(gate: Dict[str, Any]):
+    times = gate["times"]
+    async with gate["lock"]:
+        while True:
+            now = time.monotonic()
+            while times and now - times[0] >= IMAGE_HOST_RATE_WINDOW:
+                times.popleft()
+            if len(times) < IMAGE_HOST_RATE_LIMIT:
+                times.append(now)
+                return
+            await asyncio.sleep(IMAGE_HOST_RATE_WINDOW - (now - times[0]))
+
+
+def declared_content_length(resp: httpx.Response) -> int:
+    """Size to preallocate for a body, 0 when unknown or when decoding changes it."""
+    if resp.headers.get("Content-Encoding", "identity").lower() != "identity":
+        return 0
     try:
-        with SESSION.get(
-            img_url,
-            headers={**COMMON_HEADERS, "Referer": page_url},
-            stream=True,
-            timeout=5,
-        ) as img_resp:
-            if img_resp.status_code != 200:
-                print(f"[img] non-200 ({img_resp.status_code}) for id={prnt_id}")
-                return None
+        return max(0, int(resp.headers.get("Content-Length", "0")))
+    except ValueError:
+        return 0
+
+
+async def download_candidate_image(candidate: Screenshot) -> Optional[Screenshot]:
+    """Stage 2: download the screenshot under its host's own concurrency and budget."""
+    prnt_id = candidate.id
+    img_url = candidate.original_image_url
+    gate = get_image_host_gate((urlparse(img_url).netloc or "").lower())
+    async with gate["semaphore"]:
+        await acquire_image_host_budget(gate)
+        image_started = time.monotonic()
+        try:
+            async with http_client.stream(
+                "GET",
+                img_url,
+                headers={**COMMON_HEADERS, "Referer": candidate.page_url},
+                timeout=HTTP_TIMEOUT,
+            ) as img_resp:
+                if img_resp.status_code != 200:
+                    log.debug("[img] non-200 (%d) for id=%s", img_resp.status_code, prnt_id)
+                    reject_candidate(prnt_id, "image_non_200")
+                    return None
 
-            content_type = img_resp.headers.get("Content-Type", "")
-            if not content_type.startswith("image/"):
-                print(f"[img] non-image content-type={content_type} for id={prnt_id}")
-                return None
+                content_type = img_resp.headers.get("Content-Type", "")
+                if not content_type.startswith("image/"):
+                    log.debug("[img] non-image content-type=%s for id=%s", content_type, prnt_id)
+                    reject_candidate(prnt_id, "non_image")
+                    return None
 
-            image_buffer = bytearray()
-            for chunk in img_resp.iter_content(8192):
-                if not chunk:
-                    continue
-                image_buffer.extend(chunk)
-                if len(image_buffer) > MAX_IMAGE_SIZE_BYTES:
-                    print(f"[img] too large (> {MAX_IMAGE_SIZE_BYTES}) id={prnt_id}")
+                expected_size = declared_content_length(img_resp)
+                if expected_size > MAX_IMAGE_SIZE_BYTES:
+                    log.debug("[img] too large (%d) id=%s", expected_size, prnt_id)
+                    reject_candidate(prnt_id, "too_large")
                     return None
-    except requests.exceptions.RequestException as e:
-        print(f"[img] error for id={prnt_id}: {e}")
-        return None
+                # chunks are copied once, straight into their final position
+                image_buffer = bytearray(expected_size)
+                filled = 0
+                async for chunk in img_resp.aiter_bytes():
+                    end = filled + len(chunk)
+                    if end > MAX_IMAGE_SIZE_BYTES:
+                        log.debug("[img] too large (> %d) id=%s", MAX_IMAGE_SIZE_BYTES, prnt_id)
+                        reject_candidate(prnt_id, "too_large")
+                        return None
+                    image_buffer[filled:end] = chunk
+                    filled = end
+                del image_buffer[filled:]
+        except httpx.HTTPError as e:
+            log.debug("[img] error for id=%s: %s", prnt_id, e)
+            reject_candidate(prnt_id, "image_error")
+            return None
+        finally:
+            record_image_latency(time.monotonic() - image_started)
+
+    candidate.content_type = content_type
+    candidate.image_bytes = memoryview(image_buffer).toreadonly()
+    return candidate
 
-    if not image_buffer:
-        print(f"[img] empty image for id={prnt_id}")
-        return None
 
-    lowered = image_buffer[:1024].lower()
+def validate_image_item(item: Screenshot) -> bool:
+    """Stage 3 check: reject empty bodies and HTML served with an image type."""
+    prnt_id = item.id
+    image_bytes = item.image_bytes
+    if not image_bytes:
+        log.debug("[img] empty image for id=%s", prnt_id)
+        reject_candidate(prnt_id, "empty_image")
+        return False
+
+    lowered = bytes(image_bytes[:1024]).lower()
     if b"<html" in lowered or b"<!doctype html" in lowered:
-        print(f"[img] looks like HTML, not image, id={prnt_id}")
+        log.debug("[img] looks like HTML, not image, id=%s", prnt_id)
+        reject_candidate(prnt_id, "html_body")
+        return False
+    return True
+
+
+def to_sqlite_int64(value: int) -> int:
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def from_sqlite_int64(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+def phash_bands(phash: int) -> List[int]:
+    return [(phash >> shift) & mask for shift, mask in PHASH_BAND_LAYOUT]
+
+
+def index_phash(phash: int):
+    for band_idx, band in enumerate(phash_bands(phash)):
+        dedup_phash_bands[band_idx].setdefault(band, []).append(phash)
+
+
+def compute_perceptual_hash(image_bytes: memoryview) -> Optional[int]:
+    """64-bit difference hash of a 9x8 grayscale thumbnail, None if undecodable."""
+    if PILImage is None:
+        return None
+    try:
+        with PILImage.open(io.BytesIO(image_bytes)) as img:
+            img.draft("L", (PHASH_SIZE * 4, PHASH_SIZE * 4))
+            small = img.convert("L").resize((PHASH_SIZE + 1, PHASH_SIZE), PILImage.BILINEAR)
+            pixels = list(small.getdata())
+    except (OSError, ValueError, PILImage.DecompressionBombError):
         return None
+    value = 0
+    for row in range(PHASH_SIZE):
+        offset = row * (PHASH_SIZE + 1)
+        for col in range(PHASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def find_near_duplicate(phash: int) -> Optional[int]:
+    # pigeonhole: within PHASH_MAX_DISTANCE bits at least one band is equal
+    for band_idx, band in enumerate(phash_bands(phash)):
+        for known in dedup_phash_bands[band_idx].get(band, ()):
+            if bin(known ^ phash).count("1") <= PHASH_MAX_DISTANCE:
+                return known
+    return None
 
-    return {
-        "id": prnt_id,
-        "page_url": page_url,
-        "content_type": content_type,
-        "image_bytes": bytes(image_buffer),
-        "original_image_url": img_url,
-    }
 
+def init_dedup_index():
+    global dedup_conn
+    with dedup_lock:
+        if dedup_conn is None:
+            dedup_conn = sqlite3.connect(str(DISK_INDEX_PATH), isolation_level=None, check_same_thread=False)
+            dedup_conn.execute(f"PRAGMA busy_timeout={BROKER_BUSY_TIMEOUT_MS}")
+            dedup_conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS image_hashes (
+                    content_hash TEXT PRIMARY KEY,
+                    phash INTEGER,
+                    first_id TEXT NOT NULL,
+                    repeats INTEGER NOT NULL DEFAULT 1,
+                    placeholder INTEGER NOT NULL DEFAULT 0,
+                    seen_at REAL NOT NULL
+                )
+                """
+            )
+        dedup_conn.execute("DELETE FROM image_hashes WHERE seen_at < ?", (time.time() - DEDUP_RETENTION_SECONDS,))
+        dedup_content_hashes.clear()
+        dedup_placeholders.clear()
+        dedup_placeholders.update(KNOWN_PLACEHOLDER_HASHES)
+        for band in dedup_phash_bands:
+            band.clear()
+        rows = dedup_conn.execute("SELECT content_hash, phash, placeholder FROM image_hashes")
+        for content_hash, phash, placeholder in rows:
+            dedup_content_hashes.add(content_hash)
+            if placeholder:
+                dedup_placeholders.add(content_hash)
+            if phash is not None:
+                index_phash(from_sqlite_int64(phash))
+    if PILImage is None:
+        log.warning("[dedup] Pillow not installed, near-duplicate detection disabled")
+    log.info("[dedup] loaded %d content hashes", len(dedup_content_hashes))
+
+
+def register_image_fingerprint(item: Screenshot) -> Optional[str]:
+    """Hash a downloaded image; returns a rejection reason or None if it is new.
+
+    Sets item.content_hash, which also names the file in the disk tier.
+    """
+    if dedup_conn is None:
+        init_dedup_index()
+    image_bytes = item.image_bytes
+    content_hash = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+    item.content_hash = content_hash
+    if content_hash in dedup_placeholders:
+        return "placeholder"
+    now = time.time()
+    if content_hash in dedup_content_hashes:
+        with dedup_lock:
+            repeats = dedup_conn.execute(
+                "UPDATE image_hashes SET repeats = repeats + 1, seen_at = ? WHERE content_hash = ? RETURNING repeats",
+                (now, content_hash),
+            ).fetchall()
+            # the same bytes behind many unrelated IDs is a placeholder image
+            if repeats and repeats[0][0] >= PLACEHOLDER_MIN_REPEATS:
+                dedup_conn.execute("UPDATE image_hashes SET placeholder = 1 WHERE content_hash = ?", (content_hash,))
+                dedup_placeholders.add(content_hash)
+                log.info("[dedup] marked %s as placeholder after %d repeats", content_hash, repeats[0][0])
+                return "placeholder"
+        return "duplicate"
+    phash = compute_perceptual_hash(image_bytes) if DEDUP_PERCEPTUAL else None
+    with dedup_lock:
+        # the store workers hash outside the lock, the same bytes may have
+        # been registered by another one since the check above
+        if content_hash in dedup_content_hashes:
+            return "duplicate"
+        if phash is not None:
+            if find_near_duplicate(phash) is not None:
+                return "near_duplicate"
+            index_phash(phash)
+        dedup_content_hashes.add(content_hash)
+        dedup_conn.execute(
+            "INSERT OR IGNORE INTO image_hashes (content_hash, phash, first_id, seen_at) VALUES (?, ?, ?, ?)",
+            (content_hash, None if phash is None else to_sqlite_int64(phash), item.id, now),
+        )
+    return None
 
-def fetch_one_valid_screenshot(max_attempts: int = 10) -> Optional[Dict[str, Any]]:
+
+async def accept_image_item(item: Screenshot) -> bool:
+    """Stage 3: validate and dedup a downloaded image; True if it may be stored."""
+    if not validate_image_item(item):
+        return False
+    reason = await asyncio.to_thread(register_image_fingerprint, item)
+    if reason:
+        log.debug("[dedup] %s for id=%s", reason, item.id)
+        reject_candidate(item.id, reason)
+        return False
+    CANDIDATES_VALID.inc()
+    record_id_outcome(item.id, "valid")
+    return True
+
+
+def get_derivative_pool() -> ProcessPoolExecutor:
+    global derivative_pool
+    if derivative_pool is None:
+        # spawn, not fork: the fetcher already runs threads that hold locks.
+        # The encoder lives in derivatives.py so the workers import Pillow
+        # only, not this module with its app, metrics and log thread
+        derivative_pool = ProcessPoolExecutor(DERIVATIVE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return derivative_pool
+
+
+async def attach_derivatives(item: Screenshot):
+    global derivative_pool
+    if PILImage is None:
+        return
+    try:
+        variants = await asyncio.get_running_loop().run_in_executor(
+            get_derivative_pool(),
+            render_image_variants,
+            bytes(item.image_bytes),
+            DERIVATIVE_FORMAT,
+            DERIVATIVE_WIDTHS,
+            DERIVATIVE_QUALITY,
+            DERIVATIVE_MAX_PIXELS,
+        )
+    except BrokenProcessPool as exc:
+        log.error("[derive] process pool died, restarting it: %s", exc)
+        derivative_pool = None
+        return
+    item.variants = variants or None
+    if variants:
+        log.debug("[derive] id=%s variants=%s", item.id, {key: len(data) for key, data in variants.items()})
+
+
+def preferred_variant_keys(accept: str, width: Optional[int]) -> List[str]:
+    """Derivative keys to try in order; the original is the implicit fallback."""
+    if DERIVATIVE_FORMAT != "jpeg" and f"image/{DERIVATIVE_FORMAT}" not in accept:
+        return []
+    keys = []
+    if width:
+        fitting = [candidate for candidate in sorted(DERIVATIVE_WIDTHS) if candidate >= width]
+        if fitting:
+            keys.append(f"w{fitting[0]}.{DERIVATIVE_FORMAT}")
+    keys.append(DERIVATIVE_FORMAT)
+    return keys
+
+
+async def fetch_prnt_image(prnt_id: str) -> Optional[Screenshot]:
+    """Run all three stages inline for one ID (used by the live path)."""
+    candidate = await resolve_candidate(prnt_id)
+    if not candidate:
+        return None
+    item = await download_candidate_image(candidate)
+    if not item or not await accept_image_item(item):
+        return None
+    return item
+
+
+async def fetch_one_valid_screenshot(max_attempts: int = LIVE_FETCH_MAX_ATTEMPTS) -> Optional[Screenshot]:
     last_reason = "unknown"
     for i in range(max_attempts):
         prnt_id = generate_id()
-        print(f"[try] {i+1}/{max_attempts}, id={prnt_id}")
-        image_item = fetch_prnt_image(prnt_id)
+        log.debug("[try] %d/%d, id=%s", i + 1, max_attempts, prnt_id)
+        image_item = await fetch_prnt_image(prnt_id)
+        record_fetch_outcome(image_item is not None)
         if image_item:
-            print(f"[ok] id={prnt_id} ready for cache")
+            log.debug("[ok] id=%s ready for cache", prnt_id)
             return image_item
         else:
             last_reason = "no valid image / timeout / blocked"
-    print(f"[fail] couldn't find valid screenshot after {max_attempts} attempts: {last_reason}")
+    log.warning("[fail] couldn't find valid screenshot after %d attempts: %s", max_attempts, last_reason)
     return None
 
 
@@ -573,34 +2583,91 @@ def cache_len() -> int:
         return len(cache)
 
 
-def cache_pop() -> Optional[Dict[str, Any]]:
+def cache_size_bytes() -> int:
+    with cache_lock:
+        return cache_bytes
+
+
+def cache_pop() -> Optional[Screenshot]:
+    global cache_bytes
     with cache_lock:
         if cache:
-            return cache.popleft()
+            item = cache.popleft()
+            cache_bytes -= item.size
+            return item
     return None
 
 
-def cache_push(item: Dict[str, Any]) -> bool:
+def cache_pop_many(limit: int) -> List[Screenshot]:
+    global cache_bytes
     with cache_lock:
-        if len(cache) >= CACHE_MAX_SIZE:
+        items = [cache.popleft() for _ in range(min(limit, len(cache)))]
+        cache_bytes -= sum(item.size for item in items)
+    return items
+
+
+def cache_push(item: Screenshot) -> bool:
+    global cache_bytes
+    if SHARED_MODE or item.size > MEMORY_TIER_MAX_ITEM_BYTES:
+        return False
+    with cache_lock:
+        if len(cache) >= memory_tier_target or cache_bytes + item.size > MEMORY_TIER_MAX_BYTES:
             return False
         cache.append(item)
+        cache_bytes += item.size
         return True
 
 
-def get_from_cache_or_live() -> Dict[str, Any]:
+def cache_displace(item: Screenshot) -> Optional[Screenshot]:
+    """Swap item in for the largest resident if that frees enough bytes.
+
+    Keeps the most items per MB in memory when the byte budget is the limit;
+    returns the displaced item, which the caller spills to disk.
+    """
+    global cache_bytes
+    if SHARED_MODE or item.size > MEMORY_TIER_MAX_ITEM_BYTES:
+        return None
+    with cache_lock:
+        # only when the byte budget, not the item count, is what blocks item
+        if not cache or len(cache) >= memory_tier_target or cache_bytes + item.size <= MEMORY_TIER_MAX_BYTES:
+            return None
+        largest = max(cache, key=lambda resident: resident.size)
+        if largest.size <= item.size or cache_bytes - largest.size + item.size > MEMORY_TIER_MAX_BYTES:
+            return None
+        cache.remove(largest)
+        cache.append(item)
+        cache_bytes += item.size - largest.size
+        return largest
+
+
+async def get_from_cache_or_live() -> Dict[str, Any]:
     item = cache_pop()
     if item:
-        print(f"[cache] pop id={item['id']}, cache_size={cache_len()}")
+        log.debug("[cache] pop id=%s, cache_size=%d", item.id, cache_len())
+        SERVED_TOTAL.labels("memory").inc()
+        wake_prefetch_controller()
         return prepare_payload(item)
 
-    disk_item = load_item_from_disk()
+    disk_item = await asyncio.to_thread(load_item_from_disk)
+    wake_prefetch_controller()
     if disk_item:
-        print(f"[disk] serve id={disk_item['id']}")
+        log.debug("[disk] serve id=%s", disk_item.id)
+        SERVED_TOTAL.labels("disk").inc()
         return prepare_payload(disk_item)
 
-    print("[cache] empty, fetching live...")
-    item = fetch_one_valid_screenshot()
+    # a handed-over item is only in this process's memory, and its /img token
+    # would not resolve on the other workers, so shared mode waits on the disk tier
+    live_handoff = fetcher_ready and not SHARED_MODE
+    if live_handoff:
+        log.info("[cache] empty, waiting for the next fetched item...")
+        item = await wait_for_fetched_item()
+    elif fetcher_error:
+        # this process gave up the fetcher role, another worker may pick it up
+        # and fill the shared disk tier, but nothing here is coming
+        item = None
+    else:
+        log.info("[cache] empty, waiting for the fetcher...")
+        item = await wait_for_shared_item()
     if not item:
         message = "Failed to find a valid screenshot. prnt.sc might be unavailable."
         if is_prnt_banned():
@@ -608,71 +2675,423 @@ def get_from_cache_or_live() -> Dict[str, Any]:
         raise HTTPException(
             status_code=503,
             detail=message,
+            headers={"Retry-After": str(retry_after_seconds())},
         )
+    SERVED_TOTAL.labels("live" if live_handoff else "disk").inc()
     return prepare_payload(item)
 
 
-def cache_worker():
+def retry_after_seconds() -> int:
+    if is_prnt_banned():
+        return max(1, math.ceil(prnt_next_retry_ts - time.time()))
+    return ITEM_RETRY_AFTER_SECONDS
+
+
+def pending_item_waiters() -> int:
+    return sum(1 for waiter in item_waiters if not waiter.done())
+
+
+def hand_to_waiter(item: Screenshot) -> bool:
+    """Give a freshly produced item to the oldest waiting request, if any."""
+    global demand_stored_since_tick
+    while item_waiters:
+        waiter = item_waiters.popleft()
+        if not waiter.done():
+            waiter.set_result(item)
+            # counted as stored and, via the stock delta, popped right away
+            demand_stored_since_tick += 1
+            log.debug("[cache] handed id=%s to a waiting request", item.id)
+            return True
+    return False
+
+
+async def wait_for_fetched_item() -> Optional[Screenshot]:
+    # a ban outlasting the wait would only hold the connection open
+    if is_prnt_banned() and prnt_next_retry_ts - time.time() > ITEM_WAIT_SECONDS:
+        return None
+    while item_waiters and item_waiters[0].done():
+        item_waiters.popleft()
+    waiter = asyncio.get_running_loop().create_future()
+    item_waiters.append(waiter)
+    # the controller counts waiters as deficit and admits resolvers for them
+    wake_prefetch_controller()
+    try:
+        return await asyncio.wait_for(waiter, ITEM_WAIT_SECONDS)
+    except asyncio.TimeoutError:
+        return None
+    except asyncio.CancelledError:
+        # client went away after an item was handed over, keep the item
+        if waiter.done() and not waiter.cancelled():
+            await asyncio.shield(store_fetched_item(waiter.result()))
+        raise
+
+
+async def wait_for_shared_item() -> Optional[Screenshot]:
+    deadline = time.monotonic() + SHARED_QUEUE_WAIT_SECONDS
+    while time.monotonic() < deadline:
+        await asyncio.sleep(SHARED_QUEUE_POLL_SECONDS)
+        # a fetcher that is still starting up may already push to memory
+        item = cache_pop() or await asyncio.to_thread(load_item_from_disk)
+        if item:
+            return item
+    return None
+
+
+def record_page_latency(seconds: float):
+    global page_latency_ewma
+    PAGE_FETCH_SECONDS.observe(seconds)
+    page_latency_ewma += FETCH_STATS_EWMA_ALPHA * (seconds - page_latency_ewma)
+
+
+def record_image_latency(seconds: float):
+    global image_latency_ewma
+    IMAGE_FETCH_SECONDS.observe(seconds)
+    image_latency_ewma += FETCH_STATS_EWMA_ALPHA * (seconds - image_latency_ewma)
+
+
+def record_fetch_outcome(ok: bool):
+    global fetch_success_ewma
+    fetch_success_ewma += FETCH_STATS_EWMA_ALPHA * ((1.0 if ok else 0.0) - fetch_success_ewma)
+
+
+def wake_prefetch_controller():
+    prefetch_tick_event.set()
+
+
+def clamp(value: float, low: float, high: float) -> float:
+    return max(low, min(high, value))
+
+
+def update_prefetch_targets(elapsed: float, memory_depth: int, disk_depth: int):
+    """Re-derive tier targets and fetch concurrency from observed demand.
+
+    Demand is inferred from the stock delta (produced - change in stock),
+    which also counts pops made by other workers in shared mode.
+    """
+    global demand_rate_fast, demand_rate_peak, demand_stored_since_tick
+    global demand_stock_prev, memory_tier_target, disk_tier_target, fetch_concurrency_target
+
+    stock = memory_depth + disk_depth
+    popped = max(0, demand_stored_since_tick + demand_stock_prev - stock)
+    demand_stored_since_tick = 0
+    demand_stock_prev = stock
+
+    rate_now = popped / elapsed if elapsed > 0 else 0.0
+    alpha = 1 - math.exp(-elapsed / DEMAND_EWMA_FAST_SECONDS)
+    demand_rate_fast += alpha * (rate_now - demand_rate_fast)
+    decay = 0.5 ** (elapsed / DEMAND_PEAK_HALF_LIFE_SECONDS)
+    demand_rate_peak = max(demand_rate_fast, demand_rate_peak * decay)
+
+    # scales with the routes that can currently send
+    budget_rate = egress_budget_rate()
+    success = max(fetch_success_ewma, FETCH_SUCCESS_FLOOR)
+    produce_capacity = budget_rate * success
+
+    # memory should absorb the current burst on its own, the total stock
+    # should outlast the worst recent demand for PREFETCH_SLO_SECONDS
+    if SHARED_MODE:
+        memory_tier_target = 0
+    else:
+        memory_tier_target = int(
+            clamp(math.ceil(demand_rate_fast * MEMORY_TIER_SLO_SECONDS), CACHE_MIN_SIZE, CACHE_MAX_SIZE)
+        )
+    drain_rate = max(0.0, demand_rate_peak - produce_capacity)
+    disk_tier_target = int(
+        clamp(
+            math.ceil(drain_rate * PREFETCH_SLO_SECONDS),
+            min(DISK_CACHE_MIN_TARGET, DISK_CACHE_MAX_ITEMS),
+            DISK_CACHE_MAX_ITEMS,
+        )
+    )
+
+    deficit = memory_tier_target + disk_tier_target + pending_item_waiters() - stock
+    if deficit <= 0:
+        fetch_concurrency_target = 0
+    else:
+        wanted_items = demand_rate_fast + deficit / PREFETCH_REFILL_HORIZON_SECONDS
+        candidate_rate = min(budget_rate, wanted_items / success)
+        # Little's law: in-flight = arrival rate * time each candidate spends on the wire
+        # downloads run in their own stage, so only page latency matters here
+        in_flight = candidate_rate * page_latency_ewma * FETCH_CONCURRENCY_HEADROOM
+        fetch_concurrency_target = int(clamp(math.ceil(in_flight), 1, FETCH_CONCURRENCY_MAX))
+
+
+async def prefetch_controller_loop():
+    last_tick = time.monotonic()
     while True:
         try:
-            if should_idle_fetchers():
-                print("[cache] idle: memory+disk limits reached")
-                time.sleep(DISK_IDLE_SLEEP)
+            await asyncio.wait_for(prefetch_tick_event.wait(), timeout=PREFETCH_CONTROLLER_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        prefetch_tick_event.clear()
+        now = time.monotonic()
+        try:
+            disk_depth = await asyncio.to_thread(get_disk_cache_count)
+            update_prefetch_targets(now - last_tick, cache_len(), disk_depth)
+            PREFETCH_TARGETS.labels("memory_items").set(memory_tier_target)
+            PREFETCH_TARGETS.labels("disk_items").set(disk_tier_target)
+            PREFETCH_TARGETS.labels("fetch_concurrency").set(fetch_concurrency_target)
+            FETCH_YIELD.set(fetch_success_ewma)
+        except Exception as e:
+            log.exception("[prefetch] controller error: %s", e)
+        last_tick = now
+        async with prefetch_condition:
+            prefetch_condition.notify_all()
+
+
+async def wait_for_fetch_slot(worker_idx: int):
+    async with prefetch_condition:
+        await prefetch_condition.wait_for(lambda: worker_idx <= fetch_concurrency_target)
+
+
+async def store_fetched_item(item: Screenshot) -> bool:
+    global demand_stored_since_tick
+    if hand_to_waiter(item):
+        return True
+    if cache_push(item):
+        log.debug("[cache] push id=%s, cache_size=%d", item.id, cache_len())
+        demand_stored_since_tick += 1
+        return True
+    displaced = cache_displace(item)
+    if displaced is not None:
+        log.debug("[cache] id=%s displaced larger id=%s to disk", item.id, displaced.id)
+        demand_stored_since_tick += 1
+        await asyncio.to_thread(save_item_to_disk, displaced)
+        return True
+    if await asyncio.to_thread(save_item_to_disk, item):
+        demand_stored_since_tick += 1
+        return True
+    return False
+
+
+async def resolve_worker(worker_idx: int):
+    # each admitted resolver keeps one prnt.sc page in flight; the prefetch
+    # controller parks resolvers above its concurrency target, and pacing
+    # comes from the shared rate limiter and ban gate. put() blocks when
+    # downloads fall behind, which is the pipeline's backpressure.
+    while True:
+        try:
+            await wait_for_fetch_slot(worker_idx)
+            candidate = await resolve_candidate(generate_id())
+            if not candidate:
+                record_fetch_outcome(False)
                 continue
+            await resolved_queue.put(candidate)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.exception("[resolve] worker %d error: %s", worker_idx, e)
+            await asyncio.sleep(FETCH_ERROR_DELAY)
 
-            if cache_len() < CACHE_MAX_SIZE:
-                item = fetch_one_valid_screenshot()
-                if not item:
-                    time.sleep(CACHE_REFILL_DELAY_FAIL)
-                    continue
-                if cache_push(item):
-                    print(f"[cache] push id={item['id']}, cache_size={cache_len()}")
-                    time.sleep(CACHE_REFILL_DELAY_OK)
-                    continue
-                if save_item_to_disk(item):
-                    time.sleep(CACHE_REFILL_DELAY_OK)
-                else:
-                    time.sleep(CACHE_REFILL_DELAY_FAIL)
-            else:
-                time.sleep(CACHE_REFILL_DELAY_OK)
+
+async def download_worker(worker_idx: int):
+    while True:
+        candidate = await resolved_queue.get()
+        try:
+            item = await download_candidate_image(candidate)
+            if not item:
+                record_fetch_outcome(False)
+                continue
+            await downloaded_queue.put(item)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            print(f"[cache] worker error: {e}")
-            time.sleep(CACHE_REFILL_DELAY_FAIL)
+            log.exception("[download] worker %d error: %s", worker_idx, e)
+            await asyncio.sleep(FETCH_ERROR_DELAY)
+        finally:
+            resolved_queue.task_done()
 
 
-def prefill_cache(target: int):
-    target = min(target, CACHE_MAX_SIZE)
+async def store_worker(worker_idx: int):
+    while True:
+        item = await downloaded_queue.get()
+        try:
+            ok = await accept_image_item(item)
+            record_fetch_outcome(ok)
+            if ok and not hand_to_waiter(item):
+                # only stocked items are transcoded, waiting requests skip the wait
+                await attach_derivatives(item)
+                await store_fetched_item(item)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.exception("[store] worker %d error: %s", worker_idx, e)
+        finally:
+            downloaded_queue.task_done()
+
+
+async def prefill_cache(target: int):
+    target = min(target, memory_tier_target)
     while cache_len() < target:
-        item = fetch_one_valid_screenshot()
+        item = await fetch_one_valid_screenshot()
         if not item:
             break
+        if hand_to_waiter(item):
+            continue
         if cache_push(item):
-            print(f"[prefill] push id={item['id']}, cache_size={cache_len()}")
-        elif not save_item_to_disk(item):
-            print(f"[prefill] could not store id={item['id']} (cache+disk full)")
+            log.debug("[prefill] push id=%s, cache_size=%d", item.id, cache_len())
+        elif not await asyncio.to_thread(save_item_to_disk, item):
+            log.warning("[prefill] could not store id=%s (cache+disk full)", item.id)
+            break
+
+
+def warm_memory_from_disk(target: int) -> int:
+    """Move up to target disk items into the memory tier, without any network."""
+    global disk_cache_count
+    warmed = 0
+    while warmed < target and cache_len() < memory_tier_target:
+        with disk_cache_lock:
+            entry = pop_disk_index_entry()
+            if entry is None:
+                break
+            disk_cache_count = max(0, disk_cache_count - 1)
+        file_name = entry["file_name"]
+        try:
+            image_bytes, variants = read_disk_family(file_name)
+        except OSError as exc:
+            log.warning("[warm] cannot read %s: %s", file_name, exc)
+            continue
+        item = Screenshot(
+            entry["id"],
+            entry["page_url"],
+            original_image_url=entry["original_image_url"],
+            content_type=entry["content_type"],
+            image_bytes=image_bytes,
+            content_hash=file_name.split(".", 1)[0],
+            variants=variants or None,
+        )
+        remove_disk_file_family(file_name)
+        if not cache_push(item):
+            save_item_to_disk(item)
             break
+        warmed += 1
+    return warmed
+
+
+async def start_fetcher():
+    """Load fetcher state and start the pipeline; runs as a background task."""
+    global fetcher_ready
+    if SHARED_MODE:
+        await asyncio.to_thread(reconcile_disk_index)
+    init_egress_routes()
+    await asyncio.to_thread(broker_load_egress_state)
+    await asyncio.to_thread(load_id_sampler_stats)
+    await asyncio.to_thread(init_negative_cache)
+    await asyncio.to_thread(init_dedup_index)
+    fetcher_ready = True
+    fetch_tasks.append(asyncio.create_task(id_sampler_persist_loop()))
+    fetch_tasks.append(asyncio.create_task(disk_lease_sweep_loop()))
+    fetch_tasks.append(asyncio.create_task(egress_state_persist_loop()))
+    fetch_tasks.append(asyncio.create_task(egress_probe_loop()))
+    if DISK_SEGMENT_MODE:
+        # the writer also reclaims segments, so it runs before anything is queued
+        with disk_write_lock:
+            ensure_disk_writer()
+    if not SHARED_MODE:
+        warmed = await asyncio.to_thread(warm_memory_from_disk, CACHE_PREFILL_TARGET)
+        log.info("[startup] warmed %d items from disk into memory", warmed)
+        fetch_tasks.append(asyncio.create_task(prefill_cache(CACHE_PREFILL_TARGET)))
+    fetch_tasks.append(asyncio.create_task(prefetch_controller_loop()))
+    for idx in range(FETCH_CONCURRENCY_MAX):
+        fetch_tasks.append(asyncio.create_task(resolve_worker(idx + 1)))
+    for idx in range(IMAGE_DOWNLOAD_WORKERS):
+        fetch_tasks.append(asyncio.create_task(download_worker(idx + 1)))
+    for idx in range(IMAGE_STORE_WORKERS):
+        fetch_tasks.append(asyncio.create_task(store_worker(idx + 1)))
+    log.info(
+        "[startup] pid=%d is the fetcher, up to %d resolvers, %d downloaders, %d store workers",
+        os.getpid(),
+        FETCH_CONCURRENCY_MAX,
+        IMAGE_DOWNLOAD_WORKERS,
+        IMAGE_STORE_WORKERS,
+    )
+
+
+def on_fetcher_startup_done(task: asyncio.Task):
+    """Give up the fetcher role if startup failed, so another worker can take over."""
+    global fetcher_ready, fetcher_error
+    if task.cancelled() or task.exception() is None:
+        return
+    exc = task.exception()
+    log.error("[startup] pid=%d fetcher startup failed, giving up the fetcher role", os.getpid(), exc_info=exc)
+    fetcher_error = f"{type(exc).__name__}: {exc}"
+    fetcher_ready = False
+    # whatever started before the failure would keep fetching next to the new fetcher
+    for other in fetch_tasks:
+        if other is not task:
+            other.cancel()
+    release_fetcher_role()
+
+
+async def fetcher_election_loop():
+    # consumers keep trying so a replacement takes over if the fetcher dies
+    while not try_become_fetcher():
+        await asyncio.sleep(FETCHER_ELECTION_INTERVAL)
+    await start_fetcher()
 
 
 @app.on_event("startup")
-def on_startup():
-    init_disk_cache_dir()
-    prefill_cache(CACHE_PREFILL_TARGET)
-    for idx in range(CACHE_WORKER_COUNT):
-        t = threading.Thread(target=cache_worker, daemon=True)
-        t.start()
-        print(f"[startup] cache worker {idx+1} started")
+async def on_startup():
+    global http_client
+    http_client = httpx.AsyncClient(
+        follow_redirects=True,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+        ),
+    )
+    await asyncio.to_thread(init_broker)
+    # the election comes before the disk tier is opened: outside shared mode
+    # this process reconciles the disk index as if it owned storage/ alone
+    elected = try_become_fetcher()
+    if not elected and not SHARED_MODE:
+        raise RuntimeError(
+            f"another process holds {FETCHER_LOCK_PATH}; with uvicorn --workers N, set WEB_CONCURRENCY=N as well "
+            "so the workers share the disk tier"
+        )
+    await asyncio.to_thread(init_disk_cache_dir)
+    # nothing here touches the network, so uvicorn binds right away and
+    # /readyz reports when there is something to serve
+    if elected:
+        task = asyncio.create_task(start_fetcher())
+    else:
+        log.info("[startup] pid=%d is a consumer, waiting for fetcher role", os.getpid())
+        task = asyncio.create_task(fetcher_election_loop())
+    task.add_done_callback(on_fetcher_startup_done)
+    fetch_tasks.append(task)
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    for task in fetch_tasks:
+        task.cancel()
+    await asyncio.gather(*fetch_tasks, return_exceptions=True)
+    fetch_tasks.clear()
+    # a fetcher cancelled mid-startup has not loaded the stats it would overwrite
+    if fetcher_ready:
+        await asyncio.to_thread(save_id_sampler_stats)
+        await asyncio.to_thread(flush_negative_cache)
+        await asyncio.to_thread(broker_store_egress_state)
+    if derivative_pool is not None:
+        # waiting lets the workers exit and release their semaphores
+        await asyncio.to_thread(derivative_pool.shutdown, wait=True, cancel_futures=True)
+    await asyncio.to_thread(stop_disk_writer)
+    if http_client is not None:
+        await http_client.aclose()
+    await close_egress_routes()
+    flush_logging()
 
 
                                                                       
 
 
-@app.get("/", response_class=HTMLResponse)
-def show_random_html(request: Request, lang: Optional[str] = Query(None, description="Interface language code")):
-    data = get_from_cache_or_live()
-    lang = (lang or DEFAULT_LANG).lower()
-    if lang not in LANGUAGE_TEXT:
-        lang = DEFAULT_LANG
-    texts = LANGUAGE_TEXT[lang]
+def compile_page_templates() -> Dict[Tuple[str, bool], List[Any]]:
+    """Render the page for every language with and without the ban banner.
+
+    Each variant becomes a list of utf-8 chunks and slot names; the slots are
+    rendered as NUL-delimited markers, which no real field can contain.
+    """
+    template = templates.get_template(PAGE_TEMPLATE_NAME)
     languages = [
         {
             "code": code,
@@ -681,34 +3100,399 @@ def show_random_html(request: Request, lang: Optional[str] = Query(None, descrip
         }
         for code, info in LANGUAGE_TEXT.items()
     ]
-    context = {
-        "request": request,
-        "data": data,
-        "texts": texts,
-        "languages": languages,
-        "current_lang": lang,
-        "site_title": SITE_TITLE,
-        "default_lang": DEFAULT_LANG,
-        "emoji_list": ["✨", "⚡️", "🌠", "🎲", "🎯", "🚀", "🌈", "🌀", "💫"],
-    }
+    markers = {slot: f"\x00{slot}\x00" for slot in PAGE_SLOTS}
+    compiled = {}
+    for lang, texts in LANGUAGE_TEXT.items():
+        for banned in (False, True):
+            context = {
+                "data": markers,
+                "texts": texts,
+                "languages": languages,
+                "current_lang": lang,
+                "site_title": SITE_TITLE,
+                "default_lang": DEFAULT_LANG,
+                "emoji_list": PAGE_EMOJI_LIST,
+            }
+            if banned:
+                context["prnt_ban_message"] = BAN_NOTICE_TEXT
+            # re.split alternates static text and captured slot names
+            parts = PAGE_SLOT_PATTERN.split(template.render(context))
+            compiled[(lang, banned)] = [
+                part.encode() if idx % 2 == 0 else part for idx, part in enumerate(parts)
+            ]
+    return compiled
+
+
+def get_page_template(lang: str, banned: bool) -> List[Any]:
+    global page_templates, page_template_mtime, page_template_checked_at
+    now = time.monotonic()
+    if now - page_template_checked_at >= PAGE_TEMPLATE_CHECK_SECONDS or not page_templates:
+        page_template_checked_at = now
+        mtime = os.stat(Path(templates.env.loader.searchpath[0]) / PAGE_TEMPLATE_NAME).st_mtime
+        if mtime != page_template_mtime or not page_templates:
+            page_templates = compile_page_templates()
+            page_template_mtime = mtime
+            log.info("[page] pre-rendered %d page variants", len(page_templates))
+    return page_templates[(lang, banned)]
+
+
+def render_page(parts: List[Any], data: Dict[str, Any]) -> bytes:
+    return b"".join(
+        part if idx % 2 == 0 else str(html_escape(str(data.get(part) or ""))).encode()
+        for idx, part in enumerate(parts)
+    )
+
+
+@app.get("/", response_class=HTMLResponse)
+async def show_random_html(lang: Optional[str] = Query(None, description="Interface language code")):
+    with ROOT_RENDER_SECONDS.time():
+        return await render_random_html(lang)
+
+
+async def render_random_html(lang: Optional[str]) -> HTMLResponse:
+    data = await get_from_cache_or_live()
+    lang = (lang or DEFAULT_LANG).lower()
+    if lang not in LANGUAGE_TEXT:
+        lang = DEFAULT_LANG
+    parts = get_page_template(lang, get_prnt_ban_message() is not None)
+    return HTMLResponse(content=render_page(parts, data))
+
+
+@app.get("/api/random")
+async def api_random():
+    payload = await get_from_cache_or_live()
     ban_message = get_prnt_ban_message()
     if ban_message:
-        context["prnt_ban_message"] = ban_message
-    return templates.TemplateResponse("show_random.html", context)
+        payload["prnt_ban_message"] = ban_message
+    return payload
+
+
+@app.get("/api/random/batch")
+async def api_random_batch(n: int = Query(API_BATCH_DEFAULT, ge=1, le=API_BATCH_MAX)):
+    """Up to n stocked items for client-side preloading, memory tier first, then disk."""
+    items = cache_pop_many(n)
+    SERVED_TOTAL.labels("memory").inc(len(items))
+    if len(items) < n:
+        disk_items = await asyncio.to_thread(load_items_from_disk, n - len(items))
+        SERVED_TOTAL.labels("disk").inc(len(disk_items))
+        items.extend(disk_items)
+    wake_prefetch_controller()
+    # preloads never wait for the fetcher: with both tiers empty the client
+    # gets nothing and falls back to "/", which queues for the next item
+    response = {"items": [prepare_payload(item) for item in items]}
+    ban_message = get_prnt_ban_message()
+    if ban_message:
+        response["prnt_ban_message"] = ban_message
+    return response
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    candidates = [value.strip().removeprefix("W/") for value in header.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+def parse_byte_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Inclusive (start, end) of a single bytes range, None to send the whole file.
+
+    Multi-range and malformed headers, including a last byte before the
+    first, fall back to a full response as RFC 9110 asks; a range starting
+    past the end raises 416.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            start, end = max(0, size - int(last)), size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+def locate_disk_blob(name: str) -> Any:
+    """An os.stat_result for a loose file, a memoryview for a segment blob."""
+    if DISK_SEGMENT_MODE:
+        return disk_blob_view(name)
+    try:
+        return os.stat(DISK_CACHE_DIR / name)
+    except FileNotFoundError:
+        return None
+
+
+def find_disk_variant(file_name: str, accept: str, width: Optional[int]) -> Tuple[str, Any]:
+    for key in preferred_variant_keys(accept, width):
+        variant_name = disk_variant_name(file_name, key)
+        source = locate_disk_blob(variant_name)
+        if source is not None:
+            return variant_name, source
+    return file_name, locate_disk_blob(file_name)
 
 
 @app.get("/storage/{file_name}")
-def serve_cached_image(file_name: str, background_tasks: BackgroundTasks):
+def serve_cached_image(file_name: str, request: Request, w: Optional[int] = Query(None, ge=1)):
     safe_name = sanitize_disk_file_name(file_name)
     if not safe_name:
         raise HTTPException(status_code=404, detail="Image was removed.")
-    file_path = DISK_CACHE_DIR / safe_name
-    if not file_path.exists():
+    served_name, source = find_disk_variant(safe_name, request.headers.get("Accept", ""), w)
+    etag = f'"{served_name}"'
+    headers = {"ETag": etag, "Cache-Control": DISK_CACHE_CONTROL, "Accept-Ranges": "bytes", "Vary": "Accept"}
+    if source is None:
         raise HTTPException(status_code=404, detail="Image was removed.")
-    with disk_serving_lock:
-        inflight = disk_serving_registry.pop(safe_name, None)
-    content_type = guess_content_type_from_name(safe_name)
-    if inflight:
-        content_type = inflight.get("content_type", content_type)
-    background_tasks.add_task(mark_disk_file_served, safe_name)
-    return FileResponse(file_path, media_type=content_type, filename=safe_name)
+    # names are content hashes, so a matching ETag means the client has these bytes
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=304, headers=headers)
+    in_segment = isinstance(source, memoryview)
+    size = len(source) if in_segment else source.st_size
+    file_path = DISK_CACHE_DIR / served_name
+    content_type = guess_content_type_from_name(served_name)
+
+    range_header = request.headers.get("Range")
+    if_range = request.headers.get("If-Range")
+    byte_range = None
+    if range_header and (not if_range or if_range.strip() == etag):
+        byte_range = parse_byte_range(range_header, size)
+    if byte_range:
+        # partial responses do not use up the lease
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        if in_segment:
+            return MemoryImageResponse(
+                content=source[start : end + 1], status_code=206, media_type=content_type, headers=headers
+            )
+        with open(file_path, "rb") as image_file:
+            body = os.pread(image_file.fileno(), end - start + 1, start)
+        return Response(content=body, status_code=206, media_type=content_type, headers=headers)
+
+    try:
+        leased_type = consume_disk_lease(safe_name)
+    except sqlite3.Error as exc:
+        leased_type = None
+        log.error("[disk] failed to update lease for %s: %s", safe_name, exc)
+    if leased_type and served_name == safe_name:
+        content_type = leased_type
+    if in_segment:
+        # a slice of the segment map, the kernel pages it in from the page cache
+        return MemoryImageResponse(content=source, media_type=content_type, headers=headers)
+    # FileResponse hands the path to the server (http.response.pathsend) when
+    # it advertises the extension, so the kernel copies the file via sendfile
+    return FileResponse(
+        file_path, media_type=content_type, filename=served_name, headers=headers, stat_result=source
+    )
+
+
+class MemoryImageResponse(Response):
+    """Sends the downloaded buffer as is instead of copying it into bytes."""
+
+    def render(self, content: Any) -> Any:
+        return content
+
+
+@app.get("/img/{token}")
+async def serve_memory_image(token: str, request: Request, w: Optional[int] = Query(None, ge=1)):
+    item = claim_image_handoff(token)
+    if not item:
+        raise HTTPException(status_code=404, detail="Image was removed.")
+    stem = item.content_hash or item.id
+    body, media_type, etag = item.image_bytes, item.content_type or "image/png", f'"{stem}"'
+    for key in preferred_variant_keys(request.headers.get("Accept", ""), w):
+        if item.variants and key in item.variants:
+            body, media_type, etag = item.variants[key], f"image/{DERIVATIVE_FORMAT}", f'"{stem}.{key}"'
+            break
+    headers = {
+        "ETag": etag,
+        "Cache-Control": IMAGE_HANDOFF_CACHE_CONTROL,
+        "Vary": "Accept",
+    }
+    return MemoryImageResponse(content=body, media_type=media_type, headers=headers)
+
+
+def record_lock_wait(name: str, waited: float):
+    with lock_stats_lock:
+        stats = lock_stats.get(name)
+        if stats is None:
+            stats = lock_stats[name] = dict.fromkeys(
+                ("acquisitions", "contended", "wait_seconds", "wait_max_seconds", "hold_seconds", "hold_max_seconds"),
+                0,
+            )
+        stats["acquisitions"] += 1
+        stats["wait_seconds"] += waited
+        if waited >= LOCK_CONTENDED_SECONDS:
+            stats["contended"] += 1
+        if waited > stats["wait_max_seconds"]:
+            stats["wait_max_seconds"] = waited
+    LOCK_WAIT_SECONDS.labels(name).observe(waited)
+
+
+def record_lock_hold(name: str, held: float):
+    with lock_stats_lock:
+        stats = lock_stats.get(name)
+        if stats is None:
+            # timing was switched on while the lock was held
+            return
+        stats["hold_seconds"] += held
+        if held > stats["hold_max_seconds"]:
+            stats["hold_max_seconds"] = held
+
+
+def set_lock_timing(enabled: bool):
+    global lock_timing_enabled
+    if enabled and not lock_timing_enabled:
+        with lock_stats_lock:
+            lock_stats.clear()
+    lock_timing_enabled = enabled
+    log.info("[debug] lock timing %s", "on" if enabled else "off")
+
+
+def frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(seconds: float, interval: float, idle: bool) -> Tuple[Dict[str, int], int]:
+    """Samples the stacks of every other thread in collapsed-stack format.
+
+    Threads whose innermost frame is a lock, queue or selector wait are left
+    out unless idle is set. The event loop thread shows the coroutine that is
+    running at the time of the sample, not the suspended ones.
+    """
+    own_ident = threading.get_ident()
+    stacks: Dict[str, int] = {}
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            code = frame.f_code
+            if not idle and (os.path.basename(code.co_filename), code.co_name) in PROFILE_IDLE_LEAVES:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            labels.append(thread_names.get(ident, f"thread-{ident}"))
+            stack = ";".join(reversed(labels))
+            stacks[stack] = stacks.get(stack, 0) + 1
+        samples += 1
+        time.sleep(interval)
+    return stacks, samples
+
+
+def require_admin(request: Request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+def tier_depths() -> Dict[str, int]:
+    return {"memory": cache_len(), "memory_bytes": cache_size_bytes(), "disk": get_disk_cache_count()}
+
+
+def health_status() -> str:
+    if fetcher_error:
+        return "fetcher_failed"
+    if is_fetcher_process and not fetcher_ready:
+        return "starting"
+    return "ok"
+
+
+@app.get("/healthz")
+async def healthz():
+    status = health_status()
+    body = {
+        "status": status,
+        "pid": os.getpid(),
+        "fetcher": is_fetcher_process,
+        "fetcher_ready": fetcher_ready,
+        "fetcher_error": fetcher_error,
+        "prnt_banned": is_prnt_banned(),
+        "tiers": await asyncio.to_thread(tier_depths),
+        "egress": [
+            {"route": route.name, "banned": route.ban_active, "rate": route.rate, "in_flight": route.in_flight}
+            for route in egress_routes
+        ],
+    }
+    return JSONResponse(body, status_code=503 if status == "fetcher_failed" else 200)
+
+
+@app.get("/readyz")
+async def readyz():
+    tiers = await asyncio.to_thread(tier_depths)
+    ready = tiers["memory"] + tiers["disk"] > 0
+    return JSONResponse({"ready": ready, "tiers": tiers}, status_code=200 if ready else 503)
+
+
+@app.get("/metrics")
+async def metrics():
+    TIER_ITEMS.labels("memory").set(cache_len())
+    TIER_BYTES.labels("memory").set(cache_size_bytes())
+    TIER_BYTES.labels("handoff").set(image_handoff_bytes)
+    TIER_ITEMS.labels("disk").set(await asyncio.to_thread(get_disk_cache_count))
+    PIPELINE_QUEUE_ITEMS.labels("resolved").set(resolved_queue.qsize())
+    PIPELINE_QUEUE_ITEMS.labels("downloaded").set(downloaded_queue.qsize())
+    registry = METRICS_REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # aggregate across uvicorn workers, see prometheus_client multiprocess docs
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/debug/profile", include_in_schema=False)
+async def debug_profile(
+    request: Request,
+    seconds: float = Query(5, gt=0, le=PROFILE_MAX_SECONDS),
+    interval_ms: float = Query(PROFILE_DEFAULT_INTERVAL_MS, ge=1, le=1000),
+    idle: bool = False,
+):
+    """Collapsed stacks of this worker, one "frame;frame;... count" line each.
+
+    Feed the output to flamegraph.pl or speedscope. With several uvicorn
+    workers the profile covers whichever worker took the request; the
+    fetcher runs in the pid that /healthz reports with "fetcher": true.
+    """
+    global profile_running
+    require_admin(request)
+    if profile_running:
+        raise HTTPException(status_code=409, detail="A profile is already running.")
+    profile_running = True
+    try:
+        stacks, samples = await asyncio.to_thread(sample_stacks, seconds, interval_ms / 1000, idle)
+    finally:
+        profile_running = False
+    log.info("[debug] profiled %d samples over %.1fs, %d distinct stacks", samples, seconds, len(stacks))
+    lines = [f"{stack} {count}" for stack, count in sorted(stacks.items(), key=lambda entry: -entry[1])]
+    headers = {"X-Profile-Samples": str(samples), "X-Profile-Pid": str(os.getpid()), "Cache-Control": "no-store"}
+    return PlainTextResponse("\n".join(lines) + "\n" if lines else "", headers=headers)
+
+
+@app.get("/debug/locks", include_in_schema=False)
+async def debug_locks(request: Request):
+    require_admin(request)
+    with lock_stats_lock:
+        snapshot = {name: dict(stats) for name, stats in lock_stats.items()}
+    for stats in snapshot.values():
+        stats["wait_mean_seconds"] = stats["wait_seconds"] / stats["acquisitions"] if stats["acquisitions"] else 0.0
+    return {"pid": os.getpid(), "enabled": lock_timing_enabled, "locks": snapshot}
+
+
+@app.post("/debug/locks", include_in_schema=False)
+async def debug_locks_toggle(request: Request, enabled: bool = Query(...)):
+    """Switches lock timing on or off in this worker; switching it on resets the stats."""
+    require_admin(request)
+    set_lock_timing(enabled)
+    return await debug_locks(request)